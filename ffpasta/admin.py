@@ -3,6 +3,7 @@ import weasyprint
 
 from django.contrib.admin import AdminSite
 from django.contrib import admin, messages
+from django.db import transaction
 from django.db.models import Sum
 from django.http import HttpResponse, HttpResponseRedirect
 from django.forms import ValidationError
@@ -12,7 +13,7 @@ from django.utils.formats import date_format
 from django.utils.translation import gettext_lazy as _
 from django.utils.safestring import mark_safe
 
-from . import forms, models, idoklad
+from . import forms, models, idoklad, pricing
 
 
 class ProductionAdminSite(AdminSite):
@@ -44,10 +45,14 @@ class PublishMixin:
     actions = ['publish', 'hide']
 
     def publish(self, request, queryset):
-        queryset.update(published=True)
+        for obj in queryset.filter(published=False):
+            obj.published = True
+            obj.save(update_fields=['published'])
 
     def hide(self, request, queryset):
-        queryset.update(published=False)
+        for obj in queryset.filter(published=True):
+            obj.published = False
+            obj.save(update_fields=['published'])
 
     publish.short_description = 'Publikovat'
     hide.short_description = 'Skrýt'
@@ -179,7 +184,11 @@ class CustomerAdmin(admin.ModelAdmin):
         return obj.delivery_addresses.all().exists() and not obj.delivery_addresses.filter(delivery=None)
 
     def sync_customers_to_idoklad(self, request, queryset):
-        idoklad.sync_customers_to_idoklad(customers=queryset)
+        failed = idoklad.sync_customers_to_idoklad(customers=queryset)
+        for customer, err_msg in failed:
+            messages.error(request, f'Kontakt zákazníka { customer } se nepodařilo uložit do iDokladu: { err_msg }')
+        if len(failed) < len(queryset):
+            messages.success(request, f'Synchronizováno { len(queryset) - len(failed) } z { len(queryset) } zákazníků.')
 
     def sync_customers_from_idoklad(self, request, queryset):
         idoklad.sync_customers_from_idoklad(customers=queryset)
@@ -294,13 +303,13 @@ class OrderAdmin(admin.ModelAdmin):
 
     def response_change(self, request, obj):
         if "invoice" in request.POST:
-            obj.save()
-            invoice = obj.invoice()
-            if invoice == 0:
-                self.message_user(request, "Vyfakturováno")
+            with transaction.atomic():
+                obj.save()
+                job = obj.invoice()
+            if job is not None:
+                self.message_user(request, "Fakturace byla zařazena do fronty")
             else:
-                self.message_user(request, "Nepodařilo se vyfakturovat")
-                # TO DO: log invoice fail !!!
+                self.message_user(request, "Objednávka již byla vyfakturována nebo čeká na fakturaci", messages.WARNING)
             return HttpResponseRedirect(".")
         return super().response_change(request, obj)
 
@@ -330,33 +339,42 @@ class OrderAdmin(admin.ModelAdmin):
             obj.datetime_ordered = datetime.datetime.now()
         return super().save_model(request, obj, form, change)
 
-    def reject(self, request, queryset):
-        for order in queryset:
-            err_msg = order.do_reject()
-            if err_msg:
-                messages.error(request, err_msg)
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not models.Item:
+            return super().save_formset(request, form, formset, change)
+        items = formset.save(commit=False)
+        for item in formset.deleted_objects:
+            item.delete()
+        pricing.PriceResolver(form.instance.customer_id).resolve(items)
+        for item in items:
+            item.save()
+        form.instance.refresh_totals()
+
+    def transition(self, request, queryset, to_status, done):
+        position = {id: index for index, id in enumerate(queryset.values_list('id', flat=True))}
+        moved, skipped = queryset.transition(models.Order.PENDING, to_status)
+        moved_ids = {order.id for order in moved}
+        for order in sorted(moved + skipped, key=lambda order: position[order.id]):
+            if order.id in moved_ids:
+                messages.info(request, f'Objednávka č. { order.id } byla { done }')
             else:
-                messages.info(request, f'Objednávka č. { order.id } byla odmítnuta')
+                messages.error(request, models.Order.MANAGE_ERR_MSG.format(order.id, done, order.get_status_display()))
+
+    def reject(self, request, queryset):
+        self.transition(request, queryset, models.Order.REJECTED, 'odmítnuta')
 
     def confirm(self, request, queryset):
-        for order in queryset:
-            err_msg = order.do_confirm()
-            if err_msg:
-                messages.error(request, err_msg)
-            else:
-                messages.info(request, f'Objednávka č. { order.id } byla potvrzena')
+        self.transition(request, queryset, models.Order.CONFIRMED, 'potvrzena')
 
     def complete(self, request, queryset):
-        for order in queryset:
-            err_msg = order.do_complete(user=request.user)
+        for order, err_msg in models.Order.complete_many(queryset, user=request.user):
             if err_msg:
                 messages.error(request, err_msg)
             else:
                 messages.info(request, f'Objednávka č. { order.id } byla dokončena')
 
     def create_delivery_note(self, request, queryset):
-        for order in queryset:
-            delivery_note_number = order.create_delivery_note()
+        for order, delivery_note_number in models.Order.create_delivery_notes(queryset):
             if isinstance(delivery_note_number, int):
                 messages.success(request, f'Pro objednávku č. { order.id } byl vytvořen dodací list č. { delivery_note_number }')
             else:
@@ -372,27 +390,22 @@ class OrderAdmin(admin.ModelAdmin):
             return response
 
     def invoice_by_order(self, request, queryset):
-        for order in queryset.filter(invoiced=True):
-            messages.info(request, f'Objednávka č. { order.id } již byla dříve vyfakturována.')
-        for order in queryset.filter(invoiced=False):
-            if order.invoice() == 0:
-                messages.success(request, f'Objednávka č. { order.id } byla vyfakturována.')
-            else:
-                messages.error(request, f'Objednávku č. { order.id } se nepodařilo vyfakturovat.')
+        jobs, skipped = models.InvoiceJob.enqueue(queryset, models.InvoiceJob.BY_ORDER)
+        for order in skipped:
+            messages.info(request, f'Objednávka č. { order.id } již byla vyfakturována nebo čeká na fakturaci.')
+        for job in jobs:
+            messages.success(request, f'Fakturace objednávky č. { job.orders.get().id } byla zařazena do fronty.')
 
     def invoice_by_delivery_notes(self, request, queryset):
         queryset = queryset.filter(invoiced=False, delivery_note_number__isnull=False)
         if not queryset.exists():
             messages.warning(request, f'Žádné nevyfakturované dodací listy nebyly vybrány')
             return None
-        if queryset.exclude(customer=queryset.first().customer).exists():
-            messages.warning(request, f'Vybrané dodací listy jsou pro různé zákazníky')
-            return None
-        response = models.Order.invoice_delivery_notes(queryset)
-        if response:
-            messages.error(request, f'Dodací listy se nepodařilo vyfakturovat')
-        else:
-            messages.info(request, f'Dodací listy byly úspěšně vyfakturovány')
+        jobs, skipped = models.InvoiceJob.enqueue(queryset, models.InvoiceJob.BY_DELIVERY_NOTES)
+        for order in skipped:
+            messages.info(request, f'Dodací list č. { order.delivery_note_number } již čeká na fakturaci.')
+        for job in jobs:
+            messages.info(request, f'Fakturace dodacích listů zákazníka { job.customer } byla zařazena do fronty')
 
     reject.short_description = 'odmítnout'
     confirm.short_description = 'potvrdit'
@@ -403,6 +416,35 @@ class OrderAdmin(admin.ModelAdmin):
     invoice_by_delivery_notes.short_description = 'fakturovat dodací listy'
 
 
+@admin.register(models.InvoiceJob)
+class InvoiceJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'customer', 'order_list', 'status', 'attempts', 'created', 'processed', 'last_error']
+    list_filter = ['status', 'kind']
+    list_select_related = ['customer']
+    readonly_fields = ['kind', 'customer', 'orders', 'status', 'idempotency_key', 'attempts', 'last_error',
+                       'invoice_id_idoklad', 'created', 'next_attempt', 'locked_until', 'processed']
+    actions = ['retry']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('orders')
+
+    def order_list(self, obj):
+        return ', '.join(str(order.id) for order in obj.orders.all())
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry(self, request, queryset):
+        for job in queryset:
+            if job.retry():
+                messages.info(request, f'Fakturace č. { job.id } byla znovu zařazena do fronty.')
+            else:
+                messages.warning(request, f'Fakturace č. { job.id } nemohla být opakována, protože je ve stavu { job.get_status_display() }.')
+
+    order_list.short_description = 'objednávky'
+    retry.short_description = 'opakovat'
+
+
 class TodayDeliveryOrder(models.Order):
     class Meta:
         proxy = True
@@ -426,6 +468,7 @@ class UncommittedOrder(models.Order):
 class TodayDeliveryOrderAdmin(admin.ModelAdmin):
     list_display = ['__str__', 'customer', 'customer_address', 'customer_note', 'my_note', 'get_total_price']
     list_filter = []
+    list_select_related = ['customer__user', 'address__customer__user']
 
     def get_queryset(self, request):
         queryset = super().get_queryset(request)
@@ -739,8 +782,7 @@ class ToDoOrderAdmin(admin.ModelAdmin):
         return super().save_model(request, obj, form, change)
 
     def complete(self, request, queryset):
-        for order in queryset:
-            err_msg = order.do_complete(user=request.user)
+        for order, err_msg in models.Order.complete_many(queryset, user=request.user):
             if err_msg:
                 messages.error(request, err_msg)
             else:
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class FfpastaConfig(AppConfig):
     name = 'ffpasta'
+
+    def ready(self):
+        from . import signals, widgets
+        widgets.registry.populate()
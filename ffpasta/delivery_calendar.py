@@ -0,0 +1,61 @@
+from datetime import date, timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import models
+
+DAYS_AHEAD = 60
+VERSION_KEY = 'DELIVERY_CALENDAR_VERSION'
+
+
+def get_start_day():
+    """
+    Return the first day which can be ordered, orders placed after noon can be delivered the day after tomorrow.
+    """
+    minimal = 1 if timezone.now().hour < 12 else 2
+    return date.today() + timedelta(days=minimal)
+
+
+def get_version():
+    return cache.get_or_set(VERSION_KEY, 1, None)
+
+
+def invalidate():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, None)
+
+
+def _get_weekdays(customer_id):
+    """
+    Return weekday sets for all delivery addresses of customer.
+
+    Addresses with no delivery assigned get weekdays of all deliveries.
+    """
+    deliveries = {delivery.id: delivery.get_days() for delivery in models.Delivery.objects.all()}
+    default_days = set().union(*deliveries.values())
+    weekdays = {}
+    for address_id, delivery_id in models.Address.objects.filter(customer_id=customer_id).values_list('id', 'delivery'):
+        days = weekdays.setdefault(address_id, set())
+        if delivery_id is not None:
+            days.update(deliveries[delivery_id])
+    return {address_id: days or default_days for address_id, days in weekdays.items()}
+
+
+def get_dates(customer_id):
+    """
+    Return dict of available delivery dates for every delivery address of customer.
+
+    Dates are cached per customer and cutoff window, until a delivery or address delivery changes.
+    """
+    start_day = get_start_day()
+    key = f'DELIVERY_DATES_FOR_CUSTOMER_{ customer_id }_{ start_day }_{ get_version() }'
+    dates = cache.get(key)
+    if dates is None:
+        days = [start_day + timedelta(days=d) for d in range(DAYS_AHEAD)]
+        dates = {address_id: [str(day) for day in days if day.weekday() in weekdays]
+                 for address_id, weekdays in _get_weekdays(customer_id).items()}
+        cache.set(key, dates, 86400)
+    return dates
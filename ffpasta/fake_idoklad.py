@@ -0,0 +1,206 @@
+import json, random, re, threading, time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeIdoklad:
+    """
+    Local stand-in for iDoklad api, for benchmarks and manual testing without the real service.
+
+    Serve token, Contacts (paged, with DateLastChange filter), Contacts/Default, Contacts/<id>,
+    IssuedInvoices (with OrderNumber filter) and IssuedInvoices/Default from memory.
+    Every request is delayed by latency seconds, error_rate of api requests fail with 503
+    and tokens expire after token_lifetime seconds, after that requests with them fail with 401.
+    Use it as a context manager, or call start and stop, then point IDOKLAD_API_URL and IDOKLAD_AUTH_URL
+    settings to api_url and auth_url.
+    """
+    AUTH_PATH = '/identity/server/connect/token'
+
+    def __init__(self, latency=0, error_rate=0, token_lifetime=3600, max_page_size=500, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.token_lifetime = token_lifetime
+        self.max_page_size = max_page_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.contacts = {}
+            self.invoices = {}
+            self.tokens = {}
+            self.requests = {}
+            self._ids = count(1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        fake = self
+
+        class Handler(RequestHandler):
+            pass
+        Handler.fake = fake
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def api_url(self):
+        return f'http://127.0.0.1:{ self.server.server_port }'
+
+    @property
+    def auth_url(self):
+        return self.api_url + self.AUTH_PATH
+
+    def add_contact(self, **data):
+        """
+        Store contact with given data and return it.
+        """
+        with self.lock:
+            contact = dict(self.default_contact(), **data)
+            contact['Id'] = contact.get('Id') or next(self._ids)
+            contact['DateLastChange'] = datetime.now().isoformat(timespec='seconds')
+            self.contacts[contact['Id']] = contact
+            return contact
+
+    def default_contact(self):
+        return {'Id': 0, 'CompanyName': '', 'IdentificationNumber': '', 'Email': '', 'Street': '',
+                'PostalCode': '', 'City': '', 'CountryId': 2, 'DateLastChange': None}
+
+    def default_invoice(self):
+        return {'Id': 0, 'PurchaserId': None, 'OrderNumber': '', 'Description': '', 'ItemsTextPrefix': '',
+                'IssuedInvoiceItems': [{'Name': '', 'Unit': '', 'UnitPrice': 0, 'Amount': 1, 'PriceType': 1}]}
+
+    def count_request(self, method, path):
+        endpoint = re.sub(r'/\d+$', '/<id>', path)
+        with self.lock:
+            self.requests[(method, endpoint)] = self.requests.get((method, endpoint), 0) + 1
+
+    def issue_token(self):
+        token = f'fake-{ self.random.getrandbits(64):016x}'
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_lifetime
+        return {'access_token': token, 'expires_in': self.token_lifetime, 'token_type': 'Bearer'}
+
+    def is_authorized(self, header):
+        expires = self.tokens.get((header or '')[len('Bearer '):])
+        return expires is not None and expires > time.time()
+
+    def handle(self, method, path, query, body):
+        """
+        Return status and response data of given api request.
+        """
+        if path.startswith('/api/v2/Contacts'):
+            return self.handle_contacts(method, path, query, body)
+        if path.startswith('/api/v2/IssuedInvoices'):
+            return self.handle_invoices(method, path, query, body)
+        return 404, {'Message': 'Not found'}
+
+    def handle_contacts(self, method, path, query, body):
+        match = re.match(r'^/api/v2/Contacts/(\d+)$', path)
+        if method == 'GET' and path == '/api/v2/Contacts/Default':
+            return 200, self.default_contact()
+        if method == 'GET' and path == '/api/v2/Contacts':
+            contacts = list(self.contacts.values())
+            changed_since = re.match(r'^DateLastChange~(gt|gte)~(.+)$', query.get('filter', ''))
+            if changed_since:
+                since = datetime.strptime(changed_since.group(2), '%Y-%m-%d %H:%M:%S')
+                inclusive = changed_since.group(1) == 'gte'
+                contacts = [contact for contact in contacts
+                            if datetime.fromisoformat(contact['DateLastChange']) > since or
+                            inclusive and datetime.fromisoformat(contact['DateLastChange']) == since]
+            return 200, self.page(contacts, query)
+        if method == 'POST' and path == '/api/v2/Contacts':
+            data = json.loads(body)
+            data.pop('Id', None)
+            return 200, self.add_contact(**data)
+        if match and int(match.group(1)) in self.contacts:
+            if method == 'GET':
+                return 200, self.contacts[int(match.group(1))]
+            if method == 'PUT':
+                return 200, self.add_contact(**dict(json.loads(body), Id=int(match.group(1))))
+        return 404, {'Message': 'Not found'}
+
+    def handle_invoices(self, method, path, query, body):
+        if method == 'GET' and path == '/api/v2/IssuedInvoices/Default':
+            return 200, self.default_invoice()
+        if method == 'GET' and path == '/api/v2/IssuedInvoices':
+            invoices = list(self.invoices.values())
+            order_number = re.match(r'^OrderNumber~eq~(.+)$', query.get('filter', ''))
+            if order_number:
+                invoices = [invoice for invoice in invoices if invoice.get('OrderNumber') == order_number.group(1)]
+            return 200, self.page(invoices, query)
+        if method == 'POST' and path == '/api/v2/IssuedInvoices':
+            invoice = json.loads(body)
+            if invoice.get('PurchaserId') not in self.contacts:
+                return 400, {'Message': 'Purchaser not found'}
+            with self.lock:
+                invoice['Id'] = next(self._ids)
+                self.invoices[invoice['Id']] = invoice
+            return 200, invoice
+        return 404, {'Message': 'Not found'}
+
+    def page(self, objects, query):
+        page = max(int(query.get('page', 1)), 1)
+        page_size = min(max(int(query.get('pagesize', 15)), 1), self.max_page_size)
+        return {'Data': objects[(page - 1) * page_size:page * page_size],
+                'TotalItems': len(objects),
+                'TotalPages': max(-(-len(objects) // page_size), 1)}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dispatch(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        fake = self.fake
+        fake.count_request(method, url.path)
+        if fake.latency:
+            time.sleep(fake.latency)
+        if url.path == fake.AUTH_PATH and method == 'POST':
+            return self.send_json(200, fake.issue_token())
+        if not fake.is_authorized(self.headers.get('Authorization')):
+            return self.send_json(401, {'Message': 'Unauthorized'})
+        if fake.error_rate and fake.random.random() < fake.error_rate:
+            return self.send_json(503, {'Message': 'Service unavailable'}, {'Retry-After': '0'})
+        self.send_json(*fake.handle(method, url.path, query, body))
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
@@ -5,7 +5,7 @@ from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 
 from django.contrib.auth.models import User
-from . import models
+from . import delivery_calendar, models
 
 
 class ProductChoiceIterator(forms.models.ModelChoiceIterator):
@@ -37,7 +37,10 @@ class OrderCreateUpdateForm(forms.ModelForm):
     def clean_date_required(self):
         address = self.cleaned_data.get('address')
         data = self.cleaned_data.get('date_required')
-        if self.dates and str(data) not in self.dates[address.id]:
+        if address is None:
+            return data
+        dates = self.dates if self.dates is not None else delivery_calendar.get_dates(address.customer_id)
+        if str(data) not in dates.get(address.id, []):
             raise ValidationError('Na požadované datum, není naplánován závoz.')
         return data
 
@@ -104,8 +107,7 @@ class CustomerAdminForm(forms.ModelForm):
 
 
 def save(self, order):
-    for form in self.cleaned_data:
-        models.Item.objects.create(order=order, product=form['product'], quantity=form['quantity'])
+    order.set_items([models.Item(product=form['product'], quantity=form['quantity']) for form in self.cleaned_data])
 
 
 class ItemForm(forms.Form):
@@ -1,38 +1,101 @@
-import json, requests
+import asyncio, copy, json, random, requests, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from functools import partial
 from django.conf import settings
-from django.core.cache import cache
+from django.core.cache import cache, caches
+from django.db import transaction
+from django.db.models import Max, Q
 
+from . import models
+
+
+class Item:
+    """
+    Invoice item, converted to iDoklad dictionary by to_dict just before it is sent.
+
+    Items with the same name, unit and unit price can be added together by summing their amounts.
+    """
+    __slots__ = ('name', 'unit', 'unit_price', 'amount')
+
+    def __init__(self, name, unit, unit_price, amount):
+        self.name = name
+        self.unit = unit
+        self.unit_price = unit_price
+        self.amount = amount
+
+    def __repr__(self):
+        return f'Item({ self.to_dict() })'
+
+    def __eq__(self, other):
+        return isinstance(other, Item) and self.key == other.key and self.amount == other.amount
+
+    @property
+    def key(self):
+        return self.name, self.unit, self.unit_price
+
+    def copy(self):
+        return Item(self.name, self.unit, self.unit_price, self.amount)
+
+    def to_dict(self):
+        return {'Name': self.name, 'Unit': self.unit, 'UnitPrice': self.unit_price, 'Amount': self.amount}
 
-class Item(dict):
     def _is_addable(self, other):
-        return self['Name'] == other['Name'] and \
-               self['Unit'] == other['Unit'] and \
-               self['UnitPrice'] == other['UnitPrice']
+        return self.key == other.key
 
     def _try_addable(self, other):
         if not self._is_addable(other):
-            raise TypeError(f"Diferent items {{Name:{ self['Name'] }, Unit:{ self['Unit']}, UnitPrice:{ self['UnitPrice'] }}} "\
-                            f"and {{Name:{ other['Name'] }, Unit:{ other['Unit']}, UnitPrice:{ other['UnitPrice'] }}}")
+            raise TypeError(f"Diferent items {{Name:{ self.name }, Unit:{ self.unit }, UnitPrice:{ self.unit_price }}} "\
+                            f"and {{Name:{ other.name }, Unit:{ other.unit }, UnitPrice:{ other.unit_price }}}")
 
     def __add__(self, other):
         self._try_addable(other)
         result = self.copy()
-        result['Amount'] += other['Amount']
+        result.amount += other.amount
         return result
 
     def __iadd__(self, other):
         self._try_addable(other)
-        self['Amount'] += other['Amount']
+        self.amount += other.amount
         return self
 
 
-class ItemList(list):
+class ItemList:
+    """
+    Ordered list of invoice items, where an appended item is merged with an item of the same name, unit and price.
+
+    Items are kept in a dict by their key, so merging takes constant time and first-seen order is preserved.
+    """
+    def __init__(self, items=()):
+        self._items = {}
+        for item in items:
+            self.append(item)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return f'ItemList({ list(self) })'
+
+    def __eq__(self, other):
+        return isinstance(other, ItemList) and list(self) == list(other)
+
     def append(self, new_item: Item):
-        for item in self:
-            if item._is_addable(new_item):
-                item += new_item
-                return None
-        super().append(new_item)
+        item = self._items.get(new_item.key)
+        if item is None:
+            self._items[new_item.key] = new_item.copy()
+        else:
+            item += new_item
+
+    def copy(self):
+        return ItemList(self)
+
+    def to_list(self):
+        return [item.to_dict() for item in self]
 
     def __add__(self, other):
         result = self.copy()
@@ -45,9 +108,84 @@ class ItemList(list):
         return self
 
 
+class Client:
+    """
+    HTTP client for iDoklad api.
+
+    Own a pooled keep-alive session, apply connect/read timeouts to every call
+    and retry transient failures with jittered exponential backoff, honouring Retry-After.
+    Non-idempotent requests are retried only when the server surely did not process them.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    SAFE_RETRY_STATUSES = (429, 503)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    def __init__(self, timeout=None, max_retries=None, backoff=None, max_backoff=None, pool_size=None):
+        self.timeout = timeout or getattr(settings, 'IDOKLAD_TIMEOUT', (3.05, 30))
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'IDOKLAD_MAX_RETRIES', 3)
+        self.backoff = backoff or getattr(settings, 'IDOKLAD_BACKOFF', 0.5)
+        self.max_backoff = max_backoff or getattr(settings, 'IDOKLAD_MAX_BACKOFF', 30)
+        pool_size = pool_size or getattr(settings, 'IDOKLAD_POOL_SIZE', 10)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _get_retry_after(self, response):
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def _get_delay(self, attempt, response=None):
+        retry_after = self._get_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        method = method.upper()
+        idempotent = method in self.IDEMPOTENT_METHODS
+        retry_statuses = self.RETRY_STATUSES if idempotent else self.SAFE_RETRY_STATUSES
+        retry_exceptions = (requests.ConnectionError, requests.Timeout) if idempotent else (requests.ConnectTimeout,)
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except retry_exceptions:
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if response.status_code not in retry_statuses or attempt >= self.max_retries:
+                    return response
+            time.sleep(self._get_delay(attempt, response))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+
+client = Client()
+
+
 def _get_access_token():
     """
-    Retrieve and return a new access token from iDoklad
+    Retrieve a new access token from iDoklad and return it with its lifetime in seconds
     """
     url = settings.IDOKLAD_AUTH_URL
     data = {
@@ -55,22 +193,105 @@ def _get_access_token():
         'client_id': settings.IDOKLAD_CLIENT_ID,
         'client_secret': settings.IDOKLAD_CLIENT_SECRET,
         'grant_type': 'client_credentials'}
-    response = requests.post(url=url, data=data)
-    return json.loads(response.text).get('access_token', None)
+    response = client.post(url=url, data=data)
+    data = json.loads(response.text) if response.status_code == 200 else {}
+    return data.get('access_token', None), data.get('expires_in', None)
+
+
+class TokenManager:
+    """
+    Single-flight manager of iDoklad access token.
+
+    Keep the token with its expiry in cache and refresh it proactively
+    when less than refresh_margin seconds, at most half of its lifetime, remain.
+    Only one worker refreshes the token at a time, guarded by a lock in cache, other workers wait
+    for the new token instead of requesting their own. The token and the lock are kept in the cache
+    named by IDOKLAD_TOKEN_CACHE, which is shared by all processes.
+    """
+    KEY = 'idoklad_access_token'
+    LOCK_KEY = 'idoklad_access_token_lock'
+
+    def __init__(self, refresh_margin=None, lock_timeout=None, default_expires_in=None, poll_interval=0.05,
+                 cache_alias=None):
+        self.cache_alias = cache_alias
+        self.refresh_margin = refresh_margin if refresh_margin is not None else \
+            getattr(settings, 'IDOKLAD_TOKEN_REFRESH_MARGIN', 60)
+        self.lock_timeout = lock_timeout or getattr(settings, 'IDOKLAD_TOKEN_LOCK_TIMEOUT', 10)
+        self.default_expires_in = default_expires_in or 3600
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+        self.waits = 0
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_stats(self):
+        return {'hits': self.hits, 'refreshes': self.refreshes, 'waits': self.waits}
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias or getattr(settings, 'IDOKLAD_TOKEN_CACHE', 'default')]
+
+    def _get_fresh(self):
+        cached = self.cache.get(self.KEY)
+        if cached and cached.get('refresh_at', 0) > time.time():
+            return cached['token']
+        return None
+
+    def _refresh(self):
+        token, expires_in = _get_access_token()
+        if token is None:
+            return None
+        expires_in = int(expires_in or self.default_expires_in)
+        now = time.time()
+        refresh_at = now + expires_in - min(self.refresh_margin, expires_in // 2)
+        self.cache.set(self.KEY, {'token': token, 'expires_at': now + expires_in, 'refresh_at': refresh_at}, expires_in)
+        self._count('refreshes')
+        return token
+
+    def get(self):
+        """
+        Return a valid access token, from cache or newly obtained from iDoklad.
+        """
+        token = self._get_fresh()
+        if token is not None:
+            self._count('hits')
+            return token
+        deadline = time.time() + self.lock_timeout
+        while True:
+            if self.cache.add(self.LOCK_KEY, True, self.lock_timeout):
+                try:
+                    return self._get_fresh() or self._refresh() or ''
+                finally:
+                    self.cache.delete(self.LOCK_KEY)
+            if time.time() >= deadline:
+                return self._refresh() or ''
+            time.sleep(self.poll_interval)
+            token = self._get_fresh()
+            if token is not None:
+                self._count('waits')
+                return token
+
+    def invalidate(self, token):
+        """
+        Drop given token from cache, unless another worker has already replaced it.
+        """
+        cached = self.cache.get(self.KEY)
+        if cached and cached['token'] == token:
+            self.cache.delete(self.KEY)
+
+
+token_manager = TokenManager()
 
 
 def get_access_token():
     """
     Return an access token.
-
-    Get the access token from cache or obtain a new token from iDoklad
-    and store it in cache for next use
     """
-    access_token = cache.get('idoklad_access_token', None)
-    if access_token is None:
-        cache.set('idoklad_access_token', _get_access_token(), None)
-        access_token = cache.get('idoklad_access_token', '')
-    return str(access_token)
+    return str(token_manager.get())
 
 
 def access_decorator(original_function):
@@ -85,7 +306,7 @@ def access_decorator(original_function):
         headers = {'Authorization': 'Bearer ' + access_token}
         response = original_function(headers=headers, *args, **kwargs)
         if response.status_code == 401:
-            cache.delete('idoklad_access_token')
+            token_manager.invalidate(access_token)
             access_token = get_access_token()
             headers = {'Authorization': 'Bearer ' + access_token}
             response = original_function(headers=headers, *args, **kwargs)
@@ -103,122 +324,303 @@ def get(_get, *args, **kwargs):
 @access_decorator
 def _default_invoice(headers):
     url = settings.IDOKLAD_API_URL + '/api/v2/IssuedInvoices/Default'
-    return requests.get(url=url, headers=headers)
+    return client.get(url=url, headers=headers)
+
+
+@access_decorator
+def _default_contact(headers):
+    url = settings.IDOKLAD_API_URL + '/api/v2/Contacts/Default'
+    return client.get(url=url, headers=headers)
+
+
+TEMPLATES = {
+    'invoice': _default_invoice,
+    'contact': _default_contact,
+}
+
+
+def get_template(name):
+    """
+    Return a copy of iDoklad default document of given name.
+
+    The default document is fetched from iDoklad once per IDOKLAD_TEMPLATE_TIMEOUT seconds and kept in cache,
+    every caller gets its own deep copy, so it can modify it freely.
+    """
+    key = f'idoklad_template_{ name }'
+    template = cache.get(key)
+    if template is None:
+        template = get(TEMPLATES[name])
+        if template:
+            cache.set(key, template, getattr(settings, 'IDOKLAD_TEMPLATE_TIMEOUT', 3600))
+    return copy.deepcopy(template)
+
+
+def refresh_templates(*names):
+    """
+    Drop cached iDoklad default documents of given names, or all of them, so they are fetched again on next use.
+    """
+    cache.delete_many([f'idoklad_template_{ name }' for name in names or TEMPLATES])
 
 
 @access_decorator
-def post_invoice(headers, customer, items, **kwargs):
+def post_invoice(headers, customer, items, idempotency_key=None, **kwargs):
     """
     Post new invoice to iDoklad.
 
     Get a default invoice dictionary, update it with data and send it back.
+    Idempotency key is sent as the order number, so the invoice can be found by find_invoice later.
     """
-    invoice = get(_default_invoice)
+    invoice = get_template('invoice')
     invoice['PurchaserId'] = customer.id_idoklad
+    if idempotency_key is not None:
+        invoice['OrderNumber'] = idempotency_key
     default_item = invoice['IssuedInvoiceItems'].pop(0)
     for item in items:
         new_item = default_item.copy()
-        new_item.update(item)
+        new_item.update(item.to_dict())
         new_item.update(kwargs)
         invoice['IssuedInvoiceItems'].append(new_item)
     url = settings.IDOKLAD_API_URL + '/api/v2/IssuedInvoices'
     headers.update({'Content-Type': 'application/json'})
-    return requests.post(url=url, data=json.dumps(invoice), headers=headers)
+    return client.post(url=url, data=json.dumps(invoice), headers=headers)
 
 
 @access_decorator
-def _contacts(headers):
+def _invoices(headers, order_number):
+    url = settings.IDOKLAD_API_URL + '/api/v2/IssuedInvoices'
+    params = {'filter': f'OrderNumber~eq~{ order_number }', 'pagesize': 1}
+    return client.get(url=url, headers=headers, params=params)
+
+
+def find_invoice(idempotency_key):
+    """
+    Return invoice posted to iDoklad with given idempotency key, or None if there is no such invoice.
+    """
+    response = _invoices(order_number=idempotency_key)
+    if response.status_code != 200:
+        raise requests.HTTPError(f'Invoice lookup failed with status { response.status_code }', response=response)
+    invoices = json.loads(response.text).get('Data') or []
+    return invoices[0] if invoices else None
+
+
+@access_decorator
+def _contacts(headers, page=1, page_size=None, changed_since=None):
     url = settings.IDOKLAD_API_URL + '/api/v2/Contacts'
-    return requests.get(url=url, headers=headers)
+    params = {'page': page, 'pagesize': page_size or getattr(settings, 'IDOKLAD_PAGE_SIZE', 200)}
+    if changed_since is not None:
+        params['filter'] = f'DateLastChange~gte~{ changed_since.strftime("%Y-%m-%d %H:%M:%S") }'
+    return client.get(url=url, headers=headers, params=params)
+
+
+def iter_contacts(page_size=None, changed_since=None):
+    """
+    Yield all contacts from iDoklad, or only contacts changed since given datetime, fetching them page by page.
+
+    Raise requests.HTTPError when a page can not be fetched, so the caller never takes a partial list as complete.
+    """
+    page = 1
+    while True:
+        response = _contacts(page=page, page_size=page_size, changed_since=changed_since)
+        if response.status_code != 200:
+            raise requests.HTTPError(f'Contacts page { page } failed with status { response.status_code }', response=response)
+        data = json.loads(response.text)
+        yield from data.get('Data') or []
+        if not data.get('Data') or page >= data.get('TotalPages', 1):
+            return
+        page += 1
+
+
+def normalize_ico(ico):
+    """
+    Return ico as 8 digit string, or empty string if there are no digits in it.
+    """
+    digits = ''.join(char for char in str(ico or '') if char.isdigit())
+    return digits.zfill(8) if digits else ''
+
+
+CONTACTS_CURSOR = 'idoklad_contacts_changed_since'
+
+
+def get_contacts_cursor():
+    """
+    Return the last change of iDoklad contacts seen by a complete refresh of the mirror, or None.
+    """
+    value = models.Counter.objects.filter(name=CONTACTS_CURSOR).values_list('value', flat=True).first()
+    return datetime.fromtimestamp(value) if value else None
+
+
+def refresh_contact_mirror(full=False):
+    """
+    Refresh local mirror of iDoklad contacts.
+
+    By default fetch only contacts changed since the last change seen by a complete refresh, including that second,
+    full refresh fetches all contacts and removes mirrored contacts no longer present in iDoklad.
+    Contacts are stored page by page as they are fetched and stamped as refreshed. Only after all pages
+    were fetched, contacts not refreshed by a full refresh are deleted and the last change is recorded,
+    so a failed refresh deletes nothing and the next one starts from the same point.
+    """
+    started = datetime.now()
+    changed_since = None if full else get_contacts_cursor()
+    page = []
+    for contact in iter_contacts(changed_since=changed_since):
+        page.append(contact)
+        if len(page) >= getattr(settings, 'IDOKLAD_PAGE_SIZE', 200):
+            models.IdokladContact.store(page)
+            page = []
+    with transaction.atomic():
+        models.IdokladContact.store(page)
+        if full:
+            models.IdokladContact.objects.filter(Q(refreshed__lt=started) | Q(refreshed__isnull=True)).delete()
+        last = models.IdokladContact.objects.aggregate(last=Max('date_last_change'))['last']
+        if last is not None:
+            models.Counter.objects.update_or_create(name=CONTACTS_CURSOR, defaults={'value': int(last.timestamp())})
+
+
+def index_contacts(icos):
+    """
+    Return dict of mirrored iDoklad contacts with given icos keyed by normalized ico.
+
+    When more contacts share an ico, the first one is used.
+    """
+    index = {}
+    for contact in models.IdokladContact.objects.filter(ico__in=icos).order_by('id_idoklad'):
+        index.setdefault(contact.ico, contact.get_data())
+    return index
+
+
+def _get_icos(customers):
+    return {normalize_ico(ico) for ico in customers.values_list('ico', flat=True)} - {''}
 
 
 def sync_customers_from_idoklad(customers):
     """
     Synchronize local Customers with remote contacts in iDoklad.
 
-    Get all contacts from iDoklad, then iterate through given Customer queryset
-    if contact with the same ico found, update Customer with contact's data.
+    Refresh the contact mirror, then iterate once through given Customer queryset
+    if mirrored contact with the same ico found, update Customer with contact's data.
     """
-    contacts = get(_contacts).get('Data')
+    refresh_contact_mirror()
+    contacts = index_contacts(_get_icos(customers))
     for customer in customers.iterator():
-        ico = customer.get_ico()
-        for contact in contacts:
-            if contact['IdentificationNumber'] == ico:
-                customer.id_idoklad = contact['Id']
-                customer.name = contact['CompanyName']
-                if contact['Street']:
-                    customer.street = contact['Street']
-                if contact['PostalCode']:
-                    customer.postal_code = int(contact['PostalCode'])
-                if contact['City']:
-                    customer.city = contact['City']
-                customer.save()
+        contact = contacts.get(customer.get_ico())
+        if contact is not None:
+            customer.id_idoklad = contact['Id']
+            customer.name = contact['CompanyName']
+            if contact['Street']:
+                customer.street = contact['Street']
+            if contact['PostalCode']:
+                customer.postal_code = int(contact['PostalCode'])
+            if contact['City']:
+                customer.city = contact['City']
+            customer.save()
 
 
 @access_decorator
 def _contact_by_id(headers, id):
     url = settings.IDOKLAD_API_URL + '/api/v2/Contacts/' + str(id)
-    return requests.get(url=url, headers=headers)
+    return client.get(url=url, headers=headers)
 
 
 @access_decorator
-def put_contact(headers, contact, **kwargs):
+def _put_contact(headers, contact):
+    url = settings.IDOKLAD_API_URL + '/api/v2/Contacts/' + str(contact['Id'])
+    headers.update({'Content-Type': 'application/json'})
+    return client.put(url=url, data=json.dumps(contact), headers=headers)
+
+
+def put_contact(contact, **kwargs):
     """
     Update contact in iDoklad.
 
-    Get current contact from iDoklad by id, update it, and send back to iDoklad
+    Get current contact from the mirror, or from iDoklad by id when not mirrored, update it,
+    send it back to iDoklad and mirror the result.
     """
-    remote_contact = get(_contact_by_id, id=contact['Id'])
+    mirrored = models.IdokladContact.objects.filter(id_idoklad=contact['Id']).first()
+    remote_contact = mirrored.get_data() if mirrored else get(_contact_by_id, id=contact['Id'])
     remote_contact.update(contact)
-    url = settings.IDOKLAD_API_URL + '/api/v2/Contacts/' + str(contact['Id'])
-    headers.update({'Content-Type': 'application/json'})
-    return requests.put(url=url, data=json.dumps(remote_contact), headers=headers)
+    response = _put_contact(contact=remote_contact)
+    if response.status_code == 200:
+        models.IdokladContact.store([json.loads(response.text)])
+    return response
 
 
-def sync_customers_to_idoklad(customers):
+def run_concurrently(calls, concurrency=None):
     """
-    Synchronize remote contacts in iDoklad with local Customers data.
+    Run given callables concurrently in an asyncio event loop and return their results in the same order.
 
-    Get all contacts from iDoklad, then iterate through given Customer queryset
-    if contact with the same ico found, update it with Customer's data.
-    If contact has changed, put it to iDoklad.
-    If no corresponding contact found, Post new one to iDoklad.
-    """
-    contacts = get(_contacts).get('Data')
-    for customer in customers:
-        ico = customer.get_ico()
-        contact_found = False
-        for contact in contacts:
-            if contact['IdentificationNumber'] == ico:
-                customer.id_idoklad = contact['Id']
-                contact_changed = False
-                if customer.name != contact['CompanyName']:
-                    contact['CompanyName'] = customer.name
-                    contact_changed = True
-                if customer.street and customer.street != contact['Street']:
-                    contact['Street'] = customer.street
-                    contact_changed = True
-                if customer.postal_code is not None and str(customer.postal_code) != contact['PostalCode']:
-                    contact['PostalCode'] = customer.postal_code
-                    contact_changed = True
-                if customer.city and customer.city != contact['City']:
-                    contact['City'] = customer.city
-                    contact_changed = True
-                customer.save(update_fields=['id_idoklad'])
-                if contact_changed:
-                    put_contact(contact=contact)
-                contact_found = True
-        if not contact_found:
-            response = post_contact(customer=customer)
-            if response.status_code == 200:
-                customer.id_idoklad = json.loads(response.text)['Id']
-                customer.save(update_fields=['id_idoklad'])
+    Blocking iDoklad calls are dispatched to a thread pool of concurrency workers,
+    so at most concurrency requests are in flight at once. Exceptions are returned instead of raised.
+    """
+    if not calls:
+        return []
+    concurrency = concurrency or getattr(settings, 'IDOKLAD_CONCURRENCY', 8)
 
+    async def run():
+        loop = asyncio.get_event_loop()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return await asyncio.gather(*[loop.run_in_executor(executor, call) for call in calls],
+                                        return_exceptions=True)
 
-@access_decorator
-def _default_contact(headers):
-    url = settings.IDOKLAD_API_URL + '/api/v2/Contacts/Default'
-    return requests.get(url=url, headers=headers)
+    return asyncio.run(run())
+
+
+def sync_customers_to_idoklad(customers, concurrency=None):
+    """
+    Synchronize remote contacts in iDoklad with local Customers data.
+
+    Refresh the contact mirror, then iterate once through given Customer queryset
+    if mirrored contact with the same ico found, update it with Customer's data.
+    Changed contacts are put and missing contacts are posted to iDoklad concurrently,
+    then id_idoklad of all synchronized Customers is saved at once and the mirror is updated.
+    Return list of (customer, error message) pairs of customers whose contact failed to be put or posted.
+    """
+    refresh_contact_mirror()
+    contacts = index_contacts(_get_icos(customers))
+    synchronized = []
+    calls = []
+    called = []
+    posted = []
+    for customer in customers.select_related('user').iterator():
+        contact = contacts.get(customer.get_ico())
+        if contact is not None:
+            customer.id_idoklad = contact['Id']
+            contact_changed = False
+            if customer.name != contact['CompanyName']:
+                contact['CompanyName'] = customer.name
+                contact_changed = True
+            if customer.street and customer.street != contact['Street']:
+                contact['Street'] = customer.street
+                contact_changed = True
+            if customer.postal_code is not None and str(customer.postal_code) != contact['PostalCode']:
+                contact['PostalCode'] = str(customer.postal_code)
+                contact_changed = True
+            if customer.city and customer.city != contact['City']:
+                contact['City'] = customer.city
+                contact_changed = True
+            synchronized.append(customer)
+            if contact_changed:
+                called.append(customer)
+                calls.append(partial(_put_contact, contact=contact))
+        else:
+            posted.append((len(calls), customer))
+            called.append(customer)
+            calls.append(partial(post_contact, customer=customer))
+    responses = run_concurrently(calls, concurrency)
+    for index, customer in posted:
+        response = responses[index]
+        if isinstance(response, requests.Response) and response.status_code == 200:
+            customer.id_idoklad = json.loads(response.text)['Id']
+            synchronized.append(customer)
+    models.bulk_update(synchronized, ['id_idoklad'])
+    models.IdokladContact.store([json.loads(response.text) for response in responses
+                                 if isinstance(response, requests.Response) and response.status_code == 200])
+    failed = []
+    for customer, response in zip(called, responses):
+        if isinstance(response, Exception):
+            failed.append((customer, f'{ response.__class__.__name__ }: { response }'))
+        elif response.status_code != 200:
+            failed.append((customer, f'HTTP { response.status_code }: { response.text[:200] }'))
+    return failed
 
 
 @access_decorator
@@ -226,10 +628,10 @@ def post_contact(headers, customer, **kwargs):
     """
     Post new contact to iDoklad.
 
-    Retrieve a default contact dictionary, update it with customer data and post it.
+    Get a default contact dictionary, update it with customer data and post it.
     Save customer with new id_doklad if success.
     """
-    contact = get(_default_contact)
+    contact = get_template('contact')
     contact.update({
         'CompanyName': customer.name,
         'IdentificationNumber': str(customer.ico),
@@ -240,4 +642,4 @@ def post_contact(headers, customer, **kwargs):
     })
     url = settings.IDOKLAD_API_URL + '/api/v2/Contacts'
     headers.update({'Content-Type': 'application/json'})
-    return requests.post(url=url, data=json.dumps(contact), headers=headers)
+    return client.post(url=url, data=json.dumps(contact), headers=headers)
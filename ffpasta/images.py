@@ -0,0 +1,48 @@
+import os
+import threading
+
+from django.conf import settings
+
+
+class ImageCatalog:
+    """
+    Process wide catalog of images available in a static folder.
+
+    The folder is scanned on first use only, and rescanned when its mtime changes
+    or after explicit invalidation. Iterating the catalog yields model field choices,
+    so it can be passed directly as `choices` of a field.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._names = None
+
+    def __iter__(self):
+        return iter([(name, name) for name in self.get_names()])
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime
+        except OSError:
+            return None
+
+    def get_names(self):
+        mtime = self._get_mtime()
+        names = self._names
+        if names is not None and mtime == self._mtime:
+            return names
+        with self._lock:
+            if self._names is None or mtime != self._mtime:
+                self._names = tuple(sorted(os.listdir(self.directory))) if mtime is not None else ()
+                self._mtime = mtime
+            return self._names
+
+    def invalidate(self):
+        with self._lock:
+            self._names = None
+            self._mtime = None
+
+
+product_images = ImageCatalog(os.path.join(settings.STATIC_ROOT, 'ffpasta/img/product'))
+difference_images = ImageCatalog(os.path.join(settings.BASE_DIR, 'ffpasta/static/ffpasta/img/difference'))
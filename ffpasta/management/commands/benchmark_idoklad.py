@@ -0,0 +1,77 @@
+import time
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from ffpasta import idoklad, models
+from ffpasta.fake_idoklad import FakeIdoklad
+
+
+class Command(BaseCommand):
+    help = 'Measure customers synced and invoices posted per second against a local fake iDoklad, ' \
+           'sequentially (concurrency 1) and concurrently.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=100)
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every fake iDoklad request.')
+        parser.add_argument('--error-rate', type=float, default=0, help='Share of api requests failing with 503.')
+        parser.add_argument('--token-lifetime', type=int, default=3600)
+        parser.add_argument('--concurrency', type=int, default=None)
+
+    def clear_cache(self):
+        idoklad.token_manager.cache.delete(idoklad.TokenManager.KEY)
+        idoklad.refresh_templates()
+
+    def handle(self, *args, **options):
+        count = options['customers']
+        fake = FakeIdoklad(latency=options['latency'], error_rate=options['error_rate'],
+                           token_lifetime=options['token_lifetime'], seed=0)
+        # the run is one rolled back transaction, which would block worker threads writing to a database cache
+        with fake, override_settings(IDOKLAD_API_URL=fake.api_url, IDOKLAD_AUTH_URL=fake.auth_url,
+                                     IDOKLAD_TOKEN_CACHE='default'), transaction.atomic():
+            self.clear_cache()
+            product = models.Product.objects.create(name='benchmark idoklad', img='', unit_price=1)
+            User.objects.bulk_create([User(username=f'benchmark-idoklad-{ i }') for i in range(count)])
+            users = User.objects.filter(username__startswith='benchmark-idoklad-').order_by('id')
+            models.Customer.objects.bulk_create([
+                models.Customer(name=f'benchmark { i }', user=user, ico=90000000 + i, street='Benchmarková 1',
+                                postal_code=10000, city='Praha') for i, user in enumerate(users)])
+            customers = models.Customer.objects.filter(user__in=users)
+
+            for concurrency in (1, options['concurrency']):
+                fake.reset()
+                models.IdokladContact.objects.all().delete()
+                customers.update(id_idoklad=None)
+                for customer in customers[:count // 2]:
+                    fake.add_contact(CompanyName='old name', IdentificationNumber=customer.get_ico())
+                start = time.perf_counter()
+                idoklad.sync_customers_to_idoklad(customers, concurrency=concurrency)
+                elapsed = time.perf_counter() - start
+                synced = customers.filter(id_idoklad__isnull=False).count()
+                self.report('contacts', concurrency, synced, count, elapsed, fake)
+
+                models.InvoiceJob.objects.filter(customer__in=customers).delete()
+                models.Order.objects.filter(customer__in=customers).delete()
+                for customer in customers:
+                    order = models.Order.objects.create(customer=customer, date_required=date.today())
+                    models.Item.objects.create(order=order, product=product, quantity=1, unit_price=1)
+                orders = models.Order.objects.filter(customer__in=customers)
+                jobs, skipped = models.InvoiceJob.enqueue(orders, models.InvoiceJob.BY_ORDER)
+                jobs = models.InvoiceJob.claim(ids=[job.id for job in jobs])
+                fake.requests.clear()
+                start = time.perf_counter()
+                models.InvoiceJob.process_many(jobs, concurrency=concurrency)
+                elapsed = time.perf_counter() - start
+                invoiced = orders.filter(invoiced=True).count()
+                self.report('invoices', concurrency, invoiced, len(jobs), elapsed, fake)
+
+            self.clear_cache()
+            transaction.set_rollback(True)
+
+    def report(self, name, concurrency, done, total, elapsed, fake):
+        requests = ', '.join(f'{ method } { endpoint }: { n }' for (method, endpoint), n in sorted(fake.requests.items()))
+        self.stdout.write(f'{ name }, concurrency { concurrency or "default" }: { done } of { total } in { elapsed:.2f} s, '
+                          f'{ done / elapsed:.1f}/s ({ requests })')
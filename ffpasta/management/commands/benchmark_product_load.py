@@ -0,0 +1,38 @@
+import time
+from os import listdir
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ffpasta import images, models
+
+
+class Command(BaseCommand):
+    help = 'Measure loading of Product rows with per-instance image folder scan (before) and with the image catalog (after).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        with transaction.atomic():
+            models.Product.objects.bulk_create(
+                [models.Product(name=f'benchmark {i}', slug=f'benchmark-{i}', img='', unit_price=1) for i in range(rows)],
+                batch_size=500)
+            queryset = models.Product.objects.filter(name__startswith='benchmark ')
+
+            field = models.Product._meta.get_field('img')
+            start = time.perf_counter()
+            for product in queryset.iterator():
+                field.choices = [(name, name) for name in listdir(images.product_images.directory)]
+            before = time.perf_counter() - start
+            field.choices = images.product_images
+
+            start = time.perf_counter()
+            for product in queryset.iterator():
+                pass
+            after = time.perf_counter() - start
+
+            transaction.set_rollback(True)
+        self.stdout.write(f'{ rows } rows, listdir per instance: { before:.3f} s')
+        self.stdout.write(f'{ rows } rows, image catalog: { after:.3f} s')
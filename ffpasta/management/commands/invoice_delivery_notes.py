@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from ffpasta import models
+from .process_invoice_jobs import write_report
+
+
+class Command(BaseCommand):
+    help = 'Invoice all uninvoiced delivery notes, one invoice per customer, and report the results.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date-from', type=parse_date, help='First delivery date, YYYY-MM-DD.')
+        parser.add_argument('--date-to', type=parse_date, help='Last delivery date, YYYY-MM-DD.')
+        parser.add_argument('--customer', type=int, action='append', dest='customers', help='Customer id, may repeat.')
+        parser.add_argument('--concurrency', type=int, default=None)
+
+    def handle(self, *args, **options):
+        orders = models.Order.objects.filter(invoiced=False, delivery_note_number__isnull=False)
+        if options['date_from']:
+            orders = orders.filter(date_required__gte=options['date_from'])
+        if options['date_to']:
+            orders = orders.filter(date_required__lte=options['date_to'])
+        if options['customers']:
+            orders = orders.filter(customer_id__in=options['customers'])
+        jobs, skipped = models.InvoiceJob.enqueue(orders, models.InvoiceJob.BY_DELIVERY_NOTES)
+        for order in skipped:
+            self.stdout.write(f'Dodací list č. { order.delivery_note_number } již čeká na fakturaci.')
+        jobs = models.InvoiceJob.claim(ids=[job.id for job in jobs])
+        report = models.InvoiceJob.process_many(jobs, concurrency=options['concurrency']) if jobs else []
+        write_report(self, report)
+        failed = len([job for job, err_msg in report if err_msg is not None])
+        self.stdout.write(f'{ len(report) - failed } of { len(report) } customers invoiced, '
+                          f'{ sum(job.orders.count() for job, err_msg in report if err_msg is None) } delivery notes.')
+        if failed:
+            raise CommandError(f'{ failed } invoices failed, they are retried by process_invoice_jobs.')
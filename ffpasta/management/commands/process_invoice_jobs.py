@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ffpasta import models
+
+
+def write_report(command, report):
+    for job, err_msg in report:
+        if err_msg is None:
+            command.stdout.write(f'Fakturace č. { job.id } ({ job.customer }): vyfakturováno ({ job.invoice_id_idoklad })')
+        else:
+            command.stderr.write(f'Fakturace č. { job.id } ({ job.customer }): { job.get_status_display() }, { err_msg }')
+
+
+class Command(BaseCommand):
+    help = 'Post queued invoices to iDoklad. Drains the queue once, or keeps polling it with --loop.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling the queue.')
+        parser.add_argument('--interval', type=float, default=10, help='Seconds between polls with --loop.')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--concurrency', type=int, default=None)
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = models.InvoiceJob.claim(limit=options['batch_size'])
+            if jobs:
+                write_report(self, models.InvoiceJob.process_many(jobs, concurrency=options['concurrency']))
+            if jobs and len(jobs) == options['batch_size']:
+                continue
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from ffpasta import idoklad
+
+
+class Command(BaseCommand):
+    help = 'Drop cached iDoklad default documents and fetch them again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', choices=list(idoklad.TEMPLATES))
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(idoklad.TEMPLATES)
+        idoklad.refresh_templates(*names)
+        for name in names:
+            self.stdout.write(f'{ name }: { "ok" if idoklad.get_template(name) else "failed" }')
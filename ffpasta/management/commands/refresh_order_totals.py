@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ffpasta import models
+
+
+class Command(BaseCommand):
+    help = 'Backfill stored total price, item count and summary of orders, or only verify them with --check.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report orders with outdated totals.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        order_ids = list(models.Order.objects.order_by('id').values_list('id', flat=True))
+        outdated = []
+        for start in range(0, len(order_ids), batch_size):
+            queryset = models.Order.objects.filter(id__in=order_ids[start:start + batch_size])
+            outdated += models.Order.refresh_totals_many(queryset, save=not options['check'])
+        for order in outdated:
+            self.stdout.write(f'Objednávka č. { order.id }: { order.summary } ({ order.total_price })')
+        if options['check'] and outdated:
+            raise CommandError(f'{ len(outdated) } of { len(order_ids) } orders have outdated totals.')
+        self.stdout.write(f'{ len(outdated) } of { len(order_ids) } orders {"would be" if options["check"] else "were"} updated.')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ffpasta import idoklad, models
+
+
+class Command(BaseCommand):
+    help = 'Synchronize customers with iDoklad contacts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('direction', choices=['to', 'from'],
+                            help='"to" updates iDoklad contacts by customers, "from" updates customers by iDoklad contacts.')
+        parser.add_argument('--concurrency', type=int, default=None)
+        parser.add_argument('--full', action='store_true', help='Refresh the whole local mirror of iDoklad contacts first.')
+
+    def handle(self, *args, **options):
+        customers = models.Customer.objects.filter(ico__isnull=False)
+        if options['full']:
+            idoklad.refresh_contact_mirror(full=True)
+        failed = []
+        if options['direction'] == 'to':
+            failed = idoklad.sync_customers_to_idoklad(customers, concurrency=options['concurrency'])
+        else:
+            idoklad.sync_customers_from_idoklad(customers)
+        for customer, err_msg in failed:
+            self.stderr.write(f'Zákazník { customer } (IČO { customer.get_ico() }): { err_msg }')
+        count = customers.count()
+        if failed:
+            raise CommandError(f'{ len(failed) } of { count } customers failed to synchronize.')
+        self.stdout.write(f'{ count } customers synchronized.')
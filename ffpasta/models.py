@@ -1,20 +1,46 @@
-import json
-from os import listdir
+import json, requests, uuid
 from datetime import date, datetime, timedelta
+from functools import partial
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db import models, transaction
+from django.db import connections, models, router, transaction
+from django.db.models.functions import Greatest
 from django.forms.models import model_to_dict
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.crypto import get_random_string
 from django.utils.text import slugify
 from ckeditor.fields import RichTextField
 
 
-from . import idoklad, widgets
+from . import delivery_calendar, idoklad, images, pricing, widgets
+
+
+def bulk_update(objs, field_names, batch_size=None):
+    """
+    Update given fields of saved model instances by UPDATE queries with CASE expressions.
+
+    Instances are updated in batches fitting the query parameter limit of the database, all in one transaction.
+    """
+    if not objs:
+        return 0
+    model = type(objs[0])
+    max_query_params = connections[router.db_for_write(model)].features.max_query_params
+    if batch_size is None and max_query_params:
+        batch_size = max(max_query_params // (len(field_names) * 2 + 1), 1)
+    batch_size = batch_size or len(objs)
+    updated = 0
+    with transaction.atomic(using=router.db_for_write(model)):
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            updated += model._base_manager.filter(pk__in=[obj.pk for obj in batch]).update(**{
+                field_name: models.Case(*[models.When(pk=obj.pk, then=models.Value(getattr(obj, field_name))) for obj in batch],
+                                        output_field=model._meta.get_field(field_name))
+                for field_name in field_names})
+    return updated
 
 
 class PriceCategory(models.Model):
@@ -30,12 +56,9 @@ class PriceCategory(models.Model):
 
 
 class Product(models.Model):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._meta.get_field('img').choices = [(name, name) for name in listdir(settings.STATIC_ROOT + '/ffpasta/img/product')]
     name = models.CharField('název', max_length=30, unique=True)
     description = RichTextField('popis', blank=True, null=True)
-    img = models.CharField('obrázek', max_length=50)
+    img = models.CharField('obrázek', max_length=50, choices=images.product_images)
     published = models.BooleanField('publikováno', default=True)
     active = models.BooleanField('v nabídce', default=True)
     slug = models.SlugField(editable=False)
@@ -73,7 +96,7 @@ class Product(models.Model):
         return ""
 
     def one_line_description(self):
-        return self.description.replace('\n', '').replace('\r', '')
+        return (self.description or '').replace('\n', '').replace('\r', '')
 
     def get_og_title(self):
         return self.og_title or self.name
@@ -135,10 +158,42 @@ class StockTransaction(models.Model):
         if self.transaction_type == 'c' and self.order is None:
             raise ValidationError('Je třeba zadat objednávku, která má být kompletována')
 
+    def get_delta(self):
+        return self.quantity if self.transaction_type == self.PRODUCTION else - self.quantity
+
     def _process(self):
-        self.product.in_stock += self.quantity if self.transaction_type == 'p' else - self.quantity
-        self.product.in_stock = max(self.product.in_stock, 0)
-        self.product.save()
+        Product.objects.filter(id=self.product_id).update(
+            in_stock=Greatest(models.F('in_stock') + self.get_delta(), 0))
+        self.product.refresh_from_db(fields=['in_stock'])
+
+    @classmethod
+    def bulk_book(cls, stock_transactions):
+        """
+        Book many new stock transactions at once.
+
+        Movements of a product in one direction are summed and applied by a single UPDATE clamped at zero,
+        which gives the same stock as clamping after each of them. Movements of a product in both directions
+        are applied one by one in given order, as by saving them. All transactions are then inserted
+        by a single INSERT, everything in one transaction.
+        """
+        stock_transactions = list(stock_transactions)
+        deltas = {}
+        for stock_transaction in stock_transactions:
+            deltas.setdefault(stock_transaction.product_id, []).append(stock_transaction.get_delta())
+        mixed = {product_id for product_id, product_deltas in deltas.items()
+                 if min(product_deltas) < 0 < max(product_deltas)}
+        deltas = {product_id: sum(product_deltas) for product_id, product_deltas in deltas.items()
+                  if product_id not in mixed and sum(product_deltas)}
+        with transaction.atomic():
+            if deltas:
+                delta = models.Case(*[models.When(id=product_id, then=models.Value(delta)) for product_id, delta in deltas.items()],
+                                    output_field=models.IntegerField())
+                Product.objects.filter(id__in=deltas).update(in_stock=Greatest(models.F('in_stock') + delta, 0))
+            for stock_transaction in stock_transactions:
+                if stock_transaction.product_id in mixed:
+                    Product.objects.filter(id=stock_transaction.product_id).update(
+                        in_stock=Greatest(models.F('in_stock') + stock_transaction.get_delta(), 0))
+            return cls.objects.bulk_create(stock_transactions)
 
 
 class Pasta(Product):
@@ -204,12 +259,10 @@ class Delivery(models.Model):
 
     @classmethod
     def get_default_days(self):
-        field_names = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-        days = []
-        for index, field_name in enumerate(field_names):
-            if Delivery.objects.filter(**{field_name: True}).exists():
-                days.append(index)
-        return days
+        days = set()
+        for delivery in Delivery.objects.all():
+            days.update(delivery.get_days())
+        return sorted(days)
 
 
 class Price(models.Model):
@@ -246,21 +299,7 @@ class Address(models.Model):
         return f'{ self.customer }: { self.street }, { self.city }'
 
     def get_dates(self):
-        days = set()
-        for delivery in self.delivery.all():
-            days.update(delivery.get_days())
-
-        if not len(days):
-            days = Delivery.get_default_days()
-
-        dates = []
-        minimal = 1 if timezone.now().hour < 12 else 2
-        start_day = date.today() + timedelta(days=minimal)
-        for d in range(60):
-            new_date = start_day + timedelta(days=d)
-            if new_date.weekday() in days:
-                dates.append(new_date.__str__())
-        return dates
+        return delivery_calendar.get_dates(self.customer_id).get(self.id, [])
 
 
 class Customer(models.Model):
@@ -340,6 +379,112 @@ class Customer(models.Model):
         return self._original_invoice_address != model_to_dict(self, fields=['name', 'street', 'postal_code', 'city'])
 
 
+class IdokladContact(models.Model):
+    id_idoklad = models.PositiveIntegerField('id iDoklad', unique=True)
+    ico = models.CharField('ičo', max_length=8, db_index=True, blank=True)
+    company_name = models.CharField('firma', max_length=200, blank=True)
+    street = models.CharField('ulice a čp', max_length=200, blank=True)
+    postal_code = models.CharField('PSČ', max_length=20, blank=True)
+    city = models.CharField('město', max_length=200, blank=True)
+    date_last_change = models.DateTimeField('poslední změna', null=True)
+    refreshed = models.DateTimeField('obnoveno', null=True, db_index=True)
+    data = models.TextField('data')
+
+    class Meta:
+        verbose_name = 'kontakt iDokladu'
+        verbose_name_plural = 'kontakty iDokladu'
+
+    def __str__(self):
+        return f'{ self.company_name } ({ self.ico })'
+
+    def get_data(self):
+        return json.loads(self.data)
+
+    @classmethod
+    def store(cls, contacts):
+        """
+        Insert or update mirrored contacts by given contact dictionaries from iDoklad and stamp them as refreshed now.
+        """
+        refreshed = datetime.now()
+        contacts = {contact['Id']: contact for contact in contacts}
+        existing = {obj.id_idoklad: obj for obj in cls.objects.filter(id_idoklad__in=contacts)}
+        to_create = []
+        to_update = []
+        for id_idoklad, contact in contacts.items():
+            obj = existing.get(id_idoklad) or cls(id_idoklad=id_idoklad)
+            date_last_change = parse_datetime(contact.get('DateLastChange') or '')
+            if date_last_change is not None and timezone.is_aware(date_last_change):
+                date_last_change = timezone.make_naive(date_last_change)
+            obj.ico = idoklad.normalize_ico(contact.get('IdentificationNumber'))
+            obj.company_name = contact.get('CompanyName') or ''
+            obj.street = contact.get('Street') or ''
+            obj.postal_code = contact.get('PostalCode') or ''
+            obj.city = contact.get('City') or ''
+            obj.date_last_change = date_last_change
+            obj.refreshed = refreshed
+            obj.data = json.dumps(contact)
+            (to_update if obj.id else to_create).append(obj)
+        with transaction.atomic():
+            cls.objects.bulk_create(to_create)
+            bulk_update(to_update, ['ico', 'company_name', 'street', 'postal_code', 'city', 'date_last_change',
+                                    'refreshed', 'data'])
+
+
+class Counter(models.Model):
+    name = models.CharField('název', max_length=30, unique=True)
+    value = models.PositiveIntegerField('poslední hodnota', default=0)
+
+    class Meta:
+        verbose_name = 'číselná řada'
+        verbose_name_plural = 'číselné řady'
+
+    def __str__(self):
+        return f'{ self.name }: { self.value }'
+
+    @classmethod
+    def allocate(cls, name, count=1, initial=None):
+        """
+        Allocate and return range of count next numbers of the counter.
+
+        The counter row is incremented before it is read, so it stays locked until the end of
+        the surrounding transaction and rolled back numbers are reused, which keeps the row gapless.
+        When the counter does not exist yet, it is created with value returned by initial callable.
+        """
+        with transaction.atomic():
+            if not cls.objects.filter(name=name).update(value=models.F('value') + count):
+                cls.objects.get_or_create(name=name, defaults={'value': initial() if initial else 0})
+                cls.objects.filter(name=name).update(value=models.F('value') + count)
+            last = cls.objects.filter(name=name).values_list('value', flat=True).get()
+        return range(last - count + 1, last + 1)
+
+
+class OrderQuerySet(models.QuerySet):
+    def transition(self, from_status, to_status):
+        """
+        Move orders in from_status to to_status by one guarded UPDATE.
+
+        Return list of moved orders and list of orders skipped because of their current status, both in queryset order.
+        When the guarded UPDATE moves fewer orders than were read, e.g. on a database without row locks,
+        statuses are read again and orders not in to_status are reported as skipped.
+        """
+        with transaction.atomic():
+            orders = list(self.select_for_update().only('id', 'status'))
+            moved = [order for order in orders if order.status == from_status]
+            if moved:
+                count = self.model.objects.filter(id__in=[order.id for order in moved], status=from_status)\
+                    .update(status=to_status)
+                if count == len(moved):
+                    for order in moved:
+                        order.status = to_status
+                else:
+                    statuses = dict(self.model.objects.filter(id__in=[order.id for order in moved])
+                                    .values_list('id', 'status'))
+                    for order in moved:
+                        order.status = statuses.get(order.id, order.status)
+        moved_ids = {order.id for order in moved if order.status == to_status}
+        return [order for order in orders if order.id in moved_ids], [order for order in orders if order.id not in moved_ids]
+
+
 class Order(models.Model):
     REJECTED = 0
     PENDING = 1
@@ -363,6 +508,12 @@ class Order(models.Model):
     delivery_note_number = models.PositiveSmallIntegerField('č. dodacího listu', null=True, editable=False)
     delivery_note_recipient = models.CharField(max_length=150, null=True, editable=False)
 
+    total_price = models.DecimalField('celková cena', max_digits=10, decimal_places=2, default=0, editable=False)
+    item_count = models.PositiveSmallIntegerField('počet položek', default=0, editable=False)
+    summary = models.TextField('obsah', blank=True, default='', editable=False)
+
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'objednávka'
         verbose_name_plural = 'objednávky'
@@ -373,57 +524,104 @@ class Order(models.Model):
     def get_items(self):
         return self.item_set.all()
 
+    def set_items(self, items):
+        """
+        Replace items of the order with given unsaved items.
+
+        Given items are priced at once and matched with existing items by product,
+        then deletes, inserts and updates are applied by one query each, in one transaction.
+        """
+        pricing.PriceResolver(self.customer_id).resolve(items)
+        with transaction.atomic():
+            existing = {}
+            for item in self.item_set.all():
+                existing.setdefault(item.product_id, []).append(item)
+            to_create = []
+            to_update = []
+            for item in items:
+                if existing.get(item.product_id):
+                    old_item = existing[item.product_id].pop(0)
+                    if (old_item.quantity, old_item.unit_price, old_item.name) != (item.quantity, item.unit_price, item.name):
+                        old_item.quantity, old_item.unit_price, old_item.name = item.quantity, item.unit_price, item.name
+                        to_update.append(old_item)
+                else:
+                    item.order = self
+                    to_create.append(item)
+            to_delete = [item.id for rest in existing.values() for item in rest]
+            if to_delete:
+                Item.objects.filter(id__in=to_delete).delete()
+            if to_create:
+                Item.objects.bulk_create(to_create)
+            bulk_update(to_update, ['quantity', 'unit_price', 'name'])
+            self.refresh_totals()
+
     def items_to_str(self):
-        return ', '.join(['{} {}{}'.format(item.name, item.quantity, item.product.get_unit()) for item in self.get_items()])
+        return self.summary
+
+    @staticmethod
+    def summarize(items):
+        """
+        Return total price, item count and summary of given items.
+        """
+        return (sum(item.get_price() for item in items),
+                len(items),
+                ', '.join(['{} {}{}'.format(item.name, item.quantity, item.product.get_unit()) for item in items]))
+
+    @classmethod
+    def refresh_totals_many(cls, queryset, save=True):
+        """
+        Recompute stored totals and summaries of orders in queryset, return list of changed orders.
+        """
+        orders = list(queryset.only('id', 'total_price', 'item_count', 'summary').order_by())
+        items = {}
+        for item in Item.objects.filter(order_id__in=[order.id for order in orders])\
+                .select_related('product__pasta', 'product__sauce').order_by('id'):
+            items.setdefault(item.order_id, []).append(item)
+        changed = []
+        for order in orders:
+            totals = cls.summarize(items.get(order.id, []))
+            if totals != (order.total_price, order.item_count, order.summary):
+                order.total_price, order.item_count, order.summary = totals
+                changed.append(order)
+        if save:
+            bulk_update(changed, ['total_price', 'item_count', 'summary'])
+        return changed
+
+    def refresh_totals(self):
+        items = list(self.item_set.select_related('product__pasta', 'product__sauce').order_by('id'))
+        self.total_price, self.item_count, self.summary = self.summarize(items)
+        Order.objects.filter(id=self.id).update(total_price=self.total_price, item_count=self.item_count,
+                                                summary=self.summary)
 
     def items_for_idoklad(self):
-        return idoklad.ItemList([
-            idoklad.Item({
-            'Amount': item.quantity,
-            'Name': item.name,
-            'Unit': item.product.get_unit(),
-            'UnitPrice': float(item.unit_price) }) for item in self.get_items()
-        ])
-
-    def invoice(self, **kwargs):
-        response = idoklad.post_invoice(customer=self.customer, items=self.items_for_idoklad(), **kwargs)
-        if response.status_code == 200:
-            self.invoiced = True
-            self.save(update_fields=['invoiced'])
-            return 0
-        return response
+        return idoklad.ItemList(
+            idoklad.Item(
+                name=item.name,
+                unit=item.product.get_unit(),
+                unit_price=float(item.unit_price),
+                amount=item.quantity) for item in self.get_items()
+        )
+
+    def invoice(self):
+        """
+        Queue invoice of the order, return the invoice job or None if the order is invoiced or queued already.
+        """
+        jobs, skipped = InvoiceJob.enqueue(Order.objects.filter(id=self.id), InvoiceJob.BY_ORDER)
+        return jobs[0] if jobs else None
 
     @classmethod
     def delivery_notes_invoice_title(cls, queryset):
         if len(queryset) > 1:
             return  "Na základě dodacích listů:\n{}Vám fakturujeme tyto položky:".format(
                 ''.join([f'č. { order.delivery_note_number } ze dne { order.date_required }\n' for order in queryset]) )
-        order = queryset.first()
+        order = queryset[0]
         return f'Na základě dodacího listu č. { order.delivery_note_number } ze dne { order.date_required } Vám fakturujeme tyto položky:'
 
-    @classmethod
-    def invoice_delivery_notes(cls, queryset):
-        customer = queryset.first().customer if queryset.exists() else None
-        if customer is not None:
-            queryset.filter(customer=customer)  # prevent multiple customers in queryset
-            item_list = idoklad.ItemList()
-            for order in queryset.iterator():
-                item_list += order.items_for_idoklad()
-            response = idoklad.post_invoice(customer=customer, items=item_list,
-                                            ItemsTextPrefix=cls.delivery_notes_invoice_title(queryset))
-            if response.status_code == 200:
-                queryset.update(invoiced=True)
-                return 0
-            return response
-
     def is_history(self):
         return self.date_required < date.today()
 
     def get_total_price(self):
-        sum = 0
-        for item in self.get_items():
-            sum = sum + item.get_price()
-        return sum
+        return self.total_price
 
     def format_price(self):
         import locale
@@ -439,38 +637,102 @@ class Order(models.Model):
         return False
 
     def do_reject(self):
-        if self.status == self.PENDING:
+        moved, skipped = Order.objects.filter(id=self.id).transition(self.PENDING, self.REJECTED)
+        if moved:
             self.status = self.REJECTED
-            self.save(update_fields=['status'])
             return None
-        return self.MANAGE_ERR_MSG.format(self.id, 'odmítnuta', self.get_status_display())
+        return self.MANAGE_ERR_MSG.format(self.id, 'odmítnuta', skipped[0].get_status_display())
 
     def do_confirm(self):
-        if self.status == self.PENDING:
+        moved, skipped = Order.objects.filter(id=self.id).transition(self.PENDING, self.CONFIRMED)
+        if moved:
             self.status = self.CONFIRMED
-            self.save(update_fields=['status'])
             return None
-        return self.MANAGE_ERR_MSG.format(self.id, 'potvrzena', self.get_status_display())
+        return self.MANAGE_ERR_MSG.format(self.id, 'potvrzena', skipped[0].get_status_display())
 
     def do_complete(self, user):
-        if self.status == self.PENDING or self.status == self.CONFIRMED:
-            missing = self.missing_product()
-            if missing:
-                return f'Objednávka č. { self.id } nemohla být dokončena, protože na skladě není dostatek produktu { missing }.'
-            with transaction.atomic():
-                self.status = self.COMPLETED
-                self.save(update_fields=['status'])
-                for item in self.get_items():
-                    StockTransaction.objects.create(quantity=item.quantity, product=item.product, committed_by=user,
-                                                    order=self, transaction_type='c')
-            return None
-        return self.MANAGE_ERR_MSG.format(self.id, 'zabalena', self.get_status_display())
+        err_msg = Order.complete_many(Order.objects.filter(id=self.id), user)[0][1]
+        if err_msg is None:
+            self.status = self.COMPLETED
+        return err_msg
+
+    @classmethod
+    def complete_many(cls, queryset, user):
+        """
+        Complete all orders in queryset and book their products out of stock.
+
+        Total demand per product is checked against the stock first, when it does not suffice,
+        orders are checked one by one in queryset order, as if completed one after another.
+        Orders are locked while they are checked, so concurrent calls cannot complete and book them twice.
+        Return list of (order, error message or None) pairs in queryset order.
+        """
+        with transaction.atomic():
+            orders = list(queryset.select_for_update().only('id', 'status'))
+            to_complete = {order.id for order in orders if order.status in (cls.PENDING, cls.CONFIRMED)}
+            demand = dict(Item.objects.filter(order_id__in=to_complete).values_list('product_id')
+                          .annotate(demand=models.Sum('quantity')).order_by())
+            products = Product.objects.select_for_update().in_bulk(demand)
+            items = {}
+            for item in Item.objects.filter(order_id__in=to_complete).only('order_id', 'product_id', 'quantity').order_by('id'):
+                items.setdefault(item.order_id, []).append(item)
+
+            results = []
+            completed = []
+            stock = {product_id: product.in_stock for product_id, product in products.items()}
+            check_orders = any(quantity > stock[product_id] for product_id, quantity in demand.items())
+            for order in orders:
+                if order.id not in to_complete:
+                    results.append((order, cls.MANAGE_ERR_MSG.format(order.id, 'zabalena', order.get_status_display())))
+                    continue
+                order_items = items.get(order.id, [])
+                if check_orders:
+                    missing = next((item.product_id for item in order_items if item.quantity > stock[item.product_id]), None)
+                    if missing is not None:
+                        results.append((order, f'Objednávka č. { order.id } nemohla být dokončena, '
+                                               f'protože na skladě není dostatek produktu { products[missing] }.'))
+                        continue
+                    for item in order_items:
+                        stock[item.product_id] = max(stock[item.product_id] - item.quantity, 0)
+                order.status = cls.COMPLETED
+                completed.append(order)
+                results.append((order, None))
+
+            if completed:
+                cls.objects.filter(id__in=[order.id for order in completed],
+                                   status__in=(cls.PENDING, cls.CONFIRMED)).update(status=cls.COMPLETED)
+                StockTransaction.bulk_book([
+                    StockTransaction(quantity=item.quantity, product_id=item.product_id, committed_by=user,
+                                     order_id=order.id, transaction_type=StockTransaction.COMPLETION)
+                    for order in completed for item in items.get(order.id, [])])
+        return results
 
     def create_delivery_note(self):
-        if self.delivery_note_number is not None:
-            return f'Objednávka č. { self.id } již má dodací list č. { self.delivery_note_number }'
-        self.delivery_note_number = Order.next_delivery_note_number()
-        self.delivery_note_recipient = json.dumps({
+        order, result = Order.create_delivery_notes(Order.objects.filter(id=self.id))[0]
+        self.delivery_note_number = order.delivery_note_number
+        self.delivery_note_recipient = order.delivery_note_recipient
+        return result
+
+    @classmethod
+    def create_delivery_notes(cls, queryset):
+        """
+        Number delivery notes of all orders in queryset at once and freeze their recipients.
+
+        Return list of (order, delivery note number or error message) pairs in queryset order.
+        """
+        with transaction.atomic():
+            orders = list(queryset.select_for_update().select_related('customer', 'address'))
+            new_orders = [order for order in orders if order.delivery_note_number is None]
+            numbers = cls.next_delivery_note_numbers(len(new_orders)) if new_orders else []
+            for order, number in zip(new_orders, numbers):
+                order.delivery_note_number = number
+                order.delivery_note_recipient = order.get_recipient_json()
+            bulk_update(new_orders, ['delivery_note_number', 'delivery_note_recipient'])
+        new_ids = {order.id for order in new_orders}
+        return [(order, order.delivery_note_number if order.id in new_ids else
+                 f'Objednávka č. { order.id } již má dodací list č. { order.delivery_note_number }') for order in orders]
+
+    def get_recipient_json(self):
+        return json.dumps({
             'name': self.customer.name,
             'ico': str(self.customer.ico),
             'street': self.customer.street,
@@ -478,8 +740,6 @@ class Order(models.Model):
             'city': self.customer.city,
             'delivery_address': f'{ self.address.street }, { self.address.postal_code } { self.address.city }' if self.address else None
         })
-        self.save(update_fields=['delivery_note_number', 'delivery_note_recipient'])
-        return self.delivery_note_number
 
     def get_delivery_note_recipient(self):
         return json.loads(self.delivery_note_recipient if self.delivery_note_recipient else '{}')
@@ -499,8 +759,206 @@ class Order(models.Model):
 
     @classmethod
     def next_delivery_note_number(cls):
-        last = cls.objects.order_by('delivery_note_number').last()
-        return (last.delivery_note_number if last and last.delivery_note_number else 0) + 1
+        return cls.next_delivery_note_numbers(1)[0]
+
+    @classmethod
+    def next_delivery_note_numbers(cls, count):
+        return Counter.allocate('delivery_note_number', count, initial=lambda: cls.objects.aggregate(
+            last=models.Max('delivery_note_number'))['last'] or 0)
+
+
+def new_idempotency_key():
+    return uuid.uuid4().hex[:20]
+
+
+class InvoiceJob(models.Model):
+    """
+    Invoice waiting in outbox to be posted to iDoklad by process_invoice_jobs command.
+    """
+    BY_ORDER = 'o'
+    BY_DELIVERY_NOTES = 'd'
+    KIND_CHOICES = (
+        (BY_ORDER, 'objednávka'),
+        (BY_DELIVERY_NOTES, 'dodací listy'),
+    )
+    PENDING = 0
+    PROCESSING = 1
+    DONE = 2
+    FAILED = 3
+    STATUS_CHOICES = (
+        (PENDING, 'čeká'),
+        (PROCESSING, 'zpracovává se'),
+        (DONE, 'vyfakturováno'),
+        (FAILED, 'selhalo'),
+    )
+    ACTIVE_STATUSES = (PENDING, PROCESSING)
+    kind = models.CharField('druh', max_length=1, choices=KIND_CHOICES)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, verbose_name='zákazník')
+    orders = models.ManyToManyField(Order, verbose_name='objednávky', related_name='invoice_jobs')
+    status = models.SmallIntegerField('stav', default=PENDING, choices=STATUS_CHOICES, db_index=True)
+    idempotency_key = models.CharField('klíč', max_length=20, unique=True, default=new_idempotency_key, editable=False)
+    attempts = models.PositiveSmallIntegerField('pokusy', default=0)
+    last_error = models.TextField('poslední chyba', blank=True, default='')
+    invoice_id_idoklad = models.PositiveIntegerField('id faktury v iDokladu', null=True, blank=True)
+    created = models.DateTimeField('vytvořeno', auto_now_add=True)
+    next_attempt = models.DateTimeField('další pokus', default=timezone.now, db_index=True)
+    locked_until = models.DateTimeField('zamčeno do', null=True, blank=True)
+    processed = models.DateTimeField('zpracováno', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'fakturace'
+        verbose_name_plural = 'fakturace'
+        ordering = ['-created']
+
+    def __str__(self):
+        return f'{ self.get_kind_display() } { self.customer }: { self.get_status_display() }'
+
+    @classmethod
+    def enqueue(cls, orders, kind):
+        """
+        Record invoice jobs for given uninvoiced orders, skip orders already waiting for an invoice.
+
+        Return list of created jobs and list of skipped orders. Meant to run in the transaction
+        of the caller, so jobs are recorded only when the whole action succeeds.
+        """
+        with transaction.atomic():
+            orders = list(orders.select_for_update())
+            queued = set(cls.orders.through.objects.filter(
+                order_id__in=[order.id for order in orders], invoicejob__status__in=cls.ACTIVE_STATUSES
+            ).values_list('order_id', flat=True))
+            skipped = [order for order in orders if order.invoiced or order.id in queued]
+            orders = [order for order in orders if not (order.invoiced or order.id in queued)]
+            if kind == cls.BY_ORDER:
+                groups = [[order] for order in orders]
+            else:
+                by_customer = {}
+                for order in orders:
+                    by_customer.setdefault(order.customer_id, []).append(order)
+                groups = list(by_customer.values())
+            jobs = []
+            for group in groups:
+                job = cls.objects.create(kind=kind, customer_id=group[0].customer_id)
+                job.orders.set(group)
+                jobs.append(job)
+        return jobs, skipped
+
+    @classmethod
+    def claim(cls, limit=None, ids=None):
+        """
+        Claim and return jobs due to processing, optionally only jobs with given ids.
+
+        Each job is claimed by a guarded UPDATE, so concurrent workers never process the same job.
+        Processing jobs whose lock expired, e.g. because their worker crashed, are claimed again.
+        """
+        now = timezone.now()
+        lock_timeout = getattr(settings, 'INVOICE_JOB_LOCK_TIMEOUT', 300)
+        due = models.Q(status=cls.PENDING, next_attempt__lte=now) | models.Q(status=cls.PROCESSING, locked_until__lt=now)
+        queryset = cls.objects.filter(due) if ids is None else cls.objects.filter(due, id__in=ids)
+        jobs = []
+        for job in queryset.order_by('next_attempt')[:limit]:
+            claimed = cls.objects.filter(models.Q(id=job.id) & due).update(
+                status=cls.PROCESSING, attempts=models.F('attempts') + 1,
+                locked_until=now + timedelta(seconds=lock_timeout))
+            if claimed:
+                job.refresh_from_db(fields=['status', 'attempts', 'locked_until'])
+                jobs.append(job)
+        return jobs
+
+    def get_invoice_data(self):
+        """
+        Return combined item list of the job's orders and extra invoice fields.
+
+        Use process_many to prefetch orders of more jobs at once.
+        """
+        orders = self.orders.all()
+        item_list = idoklad.ItemList()
+        for order in orders:
+            item_list += order.items_for_idoklad()
+        if self.kind == self.BY_DELIVERY_NOTES:
+            return item_list, {'ItemsTextPrefix': Order.delivery_notes_invoice_title(orders)}
+        return item_list, {}
+
+    def _send(self, items, kwargs):
+        """
+        Return invoice of the job found in iDoklad or newly posted there, raise on failure.
+
+        After a failed or interrupted attempt, the invoice is looked up by idempotency key first,
+        so it is never posted twice.
+        """
+        if self.attempts > 1 or self.last_error:
+            invoice = idoklad.find_invoice(self.idempotency_key)
+            if invoice is not None:
+                return invoice
+        response = idoklad.post_invoice(customer=self.customer, items=items,
+                                        idempotency_key=self.idempotency_key, **kwargs)
+        if response.status_code != 200:
+            raise requests.HTTPError(f'{ response.status_code }: { response.text[:500] }', response=response)
+        return json.loads(response.text)
+
+    @classmethod
+    def process_many(cls, jobs, concurrency=None):
+        """
+        Post invoices of given claimed jobs to iDoklad and record the results.
+
+        Orders and their items of all jobs are loaded by a few queries up front, invoices are sent
+        concurrently by at most concurrency requests, then results are saved and orders of all
+        successful jobs are flagged as invoiced in one transaction.
+        Jobs whose invoice data cannot be built or sent are failed, they are retried with exponential backoff
+        until INVOICE_JOB_MAX_ATTEMPTS is reached.
+        Return list of (job, error message or None).
+        """
+        jobs = list(jobs)
+        models.prefetch_related_objects(jobs, 'customer', models.Prefetch(
+            'orders', queryset=Order.objects.order_by('date_required', 'id').prefetch_related(models.Prefetch(
+                'item_set', queryset=Item.objects.select_related('product__pasta', 'product__sauce')))))
+        results = {}
+        calls = []
+        sent = []
+        for job in jobs:
+            try:
+                calls.append(partial(job._send, *job.get_invoice_data()))
+                sent.append(job)
+            except Exception as e:
+                results[job.id] = e
+        results.update(zip([job.id for job in sent], idoklad.run_concurrently(calls, concurrency)))
+        now = timezone.now()
+        max_attempts = getattr(settings, 'INVOICE_JOB_MAX_ATTEMPTS', 5)
+        report = []
+        for job in jobs:
+            result = results[job.id]
+            job.locked_until = None
+            if isinstance(result, Exception):
+                job.last_error = f'{ result.__class__.__name__ }: { result }'
+                if job.attempts >= max_attempts:
+                    job.status = cls.FAILED
+                    job.processed = now
+                else:
+                    job.status = cls.PENDING
+                    job.next_attempt = now + timedelta(seconds=60 * 2 ** (job.attempts - 1))
+                report.append((job, job.last_error))
+            else:
+                job.status = cls.DONE
+                job.invoice_id_idoklad = result.get('Id')
+                job.processed = now
+                job.last_error = ''
+                report.append((job, None))
+        with transaction.atomic():
+            bulk_update(jobs, ['status', 'invoice_id_idoklad', 'processed', 'next_attempt', 'last_error', 'locked_until'])
+            Order.objects.filter(invoice_jobs__in=[job for job in jobs if job.status == cls.DONE]).update(invoiced=True)
+        return report
+
+    def process(self):
+        """
+        Post the invoice of the job to iDoklad and record the result, return True on success.
+        """
+        return type(self).process_many([self])[0][1] is None
+
+    def retry(self):
+        """
+        Return failed job back to the queue, the invoice is looked up by idempotency key before it is posted again.
+        """
+        return type(self).objects.filter(id=self.id, status=self.FAILED).update(
+            status=self.PENDING, next_attempt=timezone.now(), attempts=0, processed=None)
 
 
 class Item(models.Model):
@@ -518,14 +976,9 @@ class Item(models.Model):
         return '{} {}{}'.format(self.name, self.quantity, self.product.get_unit())
 
     def save(self, *args, **kwargs):
-        self.name = self.product.name
         if not self.unit_price:
-            user_price = Price.objects.filter(models.Q(customer=self.order.customer),
-                        models.Q(price_category=self.product.price_category) | models.Q(product=self.product)).first()
-            if user_price:
-                self.unit_price = user_price.unit_price
-            else:
-                self.unit_price = self.product.get_unit_price()
+            pricing.PriceResolver(self.order.customer_id, product_ids=[self.product_id]).resolve([self])
+        self.name = self.product.name
         return super().save(*args, **kwargs)
 
     def get_price(self):
@@ -537,7 +990,7 @@ class Section(models.Model):
     link = models.CharField('odkaz v menu', max_length=25, unique=True)
     text = RichTextField('obsah', blank=True, null=True, default=None)
     slug = models.SlugField(editable=False, unique=True)
-    widget = models.CharField(max_length=1, choices=widgets.Widget.get_choices(),
+    widget = models.CharField(max_length=1, choices=widgets.registry,
                               null=True, editable=False)
 
     class Meta:
@@ -553,7 +1006,7 @@ class Section(models.Model):
         return self.headline
 
     def get_widget(self):
-        return widgets.Widget.get_class(self.widget)
+        return widgets.registry.get(self.widget)
 
 
 class Recipe(models.Model):
@@ -571,12 +1024,8 @@ class Recipe(models.Model):
 
 
 class Difference(models.Model):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._meta.get_field('img').choices = [(name, name) for name in listdir(
-            settings.BASE_DIR + '/ffpasta/static/ffpasta/img/difference')]
     header = models.CharField('nadpis', max_length=50)
-    img = models.CharField('obrázek', max_length=50)
+    img = models.CharField('obrázek', max_length=50, choices=images.difference_images)
     ffpasta = models.CharField('ffpasta', max_length=200)
     others = models.CharField('ostatní', max_length=200)
     published = models.BooleanField('publikováno')
@@ -0,0 +1,72 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+CSRF_PLACEHOLDER = 'CSRF_TOKEN_PLACEHOLDER'
+
+
+class CachedPage:
+    """
+    Cached rendering of a page shared by all anonymous visitors.
+
+    The rendering is fresh until its version is invalidated or timeout seconds pass. A stale rendering
+    is kept and served while one worker renders a new one, the workers are coordinated by a lock in cache.
+    When there is no rendering at all, other workers wait for the one rendering it instead of rendering too.
+    Invalidation reaches other worker processes only when the default cache is shared by them.
+    """
+    def __init__(self, name, timeout=None, lock_timeout=30, poll_interval=0.05):
+        self.key = f'PAGE_{ name }'
+        self.version_key = f'PAGE_{ name }_VERSION'
+        self.lock_key = f'PAGE_{ name }_LOCK'
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    def get_timeout(self):
+        return self.timeout or getattr(settings, 'PAGE_CACHE_TIMEOUT', 600)
+
+    def get_version(self):
+        return cache.get_or_set(self.version_key, 1, None)
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, None)
+
+    def _is_fresh(self, entry):
+        return entry['version'] == self.get_version() and entry['expires'] > time.time()
+
+    def _render(self, render):
+        version = self.get_version()
+        content = render()
+        cache.set(self.key, {'content': content, 'version': version, 'expires': time.time() + self.get_timeout()}, None)
+        return content
+
+    def get(self, render):
+        """
+        Return the cached rendering, call render to create a new one when it is missing or stale.
+        """
+        entry = cache.get(self.key)
+        if entry is not None and self._is_fresh(entry):
+            return entry['content']
+        deadline = time.time() + self.lock_timeout
+        while True:
+            if cache.add(self.lock_key, True, self.lock_timeout):
+                try:
+                    entry = cache.get(self.key)
+                    if entry is not None and self._is_fresh(entry):
+                        return entry['content']
+                    return self._render(render)
+                finally:
+                    cache.delete(self.lock_key)
+            if entry is not None:
+                return entry['content']
+            if time.time() >= deadline:
+                return render()
+            time.sleep(self.poll_interval)
+            entry = cache.get(self.key)
+
+
+home_page = CachedPage('HOME')
@@ -0,0 +1,46 @@
+from . import models
+
+
+class PriceResolver:
+    """
+    Resolve unit prices of items for one customer in memory.
+
+    Customer's prices and products with their price categories are loaded once,
+    then unit price is looked up in this order:
+    price for the product, price for the product's price category, product's list price.
+    """
+    def __init__(self, customer_id, product_ids=None):
+        self.customer_id = customer_id
+        prices = models.Price.objects.filter(customer_id=customer_id)
+        products = models.Product.objects.select_related('price_category').order_by()
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        self.product_prices = {}
+        self.category_prices = {}
+        for price in prices:
+            if price.product_id is not None:
+                self.product_prices[price.product_id] = price.unit_price
+            elif price.price_category_id is not None:
+                self.category_prices[price.price_category_id] = price.unit_price
+        self.products = {product.id: product for product in products}
+
+    def get_unit_price(self, product_id):
+        if product_id in self.product_prices:
+            return self.product_prices[product_id]
+        product = self.products[product_id]
+        if product.price_category_id in self.category_prices:
+            return self.category_prices[product.price_category_id]
+        return product.get_unit_price()
+
+    def resolve(self, items):
+        """
+        Set name and missing unit price of given items.
+        """
+        for item in items:
+            product = self.products[item.product_id]
+            if not models.Item.product.is_cached(item):
+                item.product = product
+            item.name = product.name
+            if not item.unit_price:
+                item.unit_price = self.get_unit_price(item.product_id)
+        return items
@@ -0,0 +1,96 @@
+import gzip, json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils.crypto import get_random_string
+
+from . import models
+
+
+def get_version(slug):
+    """
+    Return version stamp of the product with given slug, or None when it is not known yet.
+    """
+    return cache.get(f'PRODUCT_VERSION_{ slug }')
+
+
+def invalidate(slug):
+    cache.set(f'PRODUCT_VERSION_{ slug }', get_random_string(12), None)
+    cache.set('PRODUCT_CATALOGUE_VERSION', get_random_string(12), None)
+
+
+def get_catalogue_version():
+    """
+    Return version stamp of the catalogue of published products, or None when it is not known yet.
+    """
+    return cache.get('PRODUCT_CATALOGUE_VERSION')
+
+
+def get_etag(slug, version):
+    return f'"{ slug }-{ version }"'
+
+
+def get_payload(product):
+    """
+    Return dict with Open Graph data and rendered detail of product.
+    """
+    return {
+        'ogUrl': f'https://{ settings.DOMAIN }/#{ product.slug }',
+        'ogTitle': f'FFpasta | { product.get_og_title() }',
+        'ogType': 'article',
+        'ogImage': f'https://{ settings.DOMAIN }{ product.get_og_img_url() }',
+        'ogDescription': product.get_og_description(),
+        'body': render_to_string('ffpasta/product_detail.html', {'object': product}),
+    }
+
+
+def _get_content(product, version):
+    entry = cache.get(f'PRODUCT_DETAIL_{ product.slug }')
+    if entry is not None and entry['version'] == version:
+        return entry['content']
+    content = json.dumps(get_payload(product), ensure_ascii=False)
+    cache.set(f'PRODUCT_DETAIL_{ product.slug }', {'content': content, 'version': version}, None)
+    return content
+
+
+def get_detail(slug):
+    """
+    Return JSON document with payload of product with given slug and its version, or None if there is no such product.
+
+    The document is cached until the product version changes. The version is created only for an existing product,
+    so requests for unknown slugs do not fill the cache with stamps that never expire.
+    """
+    version = get_version(slug)
+    entry = cache.get(f'PRODUCT_DETAIL_{ slug }')
+    if version is not None and entry is not None and entry['version'] == version:
+        return entry['content'], version
+    product = models.Product.objects.filter(slug=slug).first()
+    if product is None:
+        return None, version
+    version = cache.get_or_set(f'PRODUCT_VERSION_{ slug }', get_random_string(12), None)
+    return _get_content(product, version), version
+
+
+def get_catalogue():
+    """
+    Return JSON document with payloads of all published products keyed by slug, its gzipped copy and its version.
+
+    The document is composed of the cached documents of single products and cached until any product changes.
+    """
+    version = cache.get_or_set('PRODUCT_CATALOGUE_VERSION', get_random_string(12), None)
+    entry = cache.get('PRODUCT_CATALOGUE')
+    if entry is not None and entry['version'] == version:
+        return entry['content'], entry['compressed'], version
+    products = list(models.Product.objects.filter(published=True).order_by('id'))
+    versions = cache.get_many([f'PRODUCT_VERSION_{ product.slug }' for product in products])
+    missing = {f'PRODUCT_VERSION_{ product.slug }': get_random_string(12) for product in products
+               if f'PRODUCT_VERSION_{ product.slug }' not in versions}
+    cache.set_many(missing, None)
+    versions.update(missing)
+    content = '{{"version": {}, "products": {{{}}}}}'.format(json.dumps(version), ', '.join(
+        f'{ json.dumps(product.slug) }: { _get_content(product, versions[f"PRODUCT_VERSION_{ product.slug }"]) }'
+        for product in products))
+    compressed = gzip.compress(content.encode())
+    cache.set('PRODUCT_CATALOGUE', {'content': content, 'compressed': compressed, 'version': version}, None)
+    return content, compressed, version
@@ -0,0 +1,59 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import delivery_calendar, models, page_cache, product_cache, widgets
+
+
+@receiver([post_save, post_delete], sender=models.Delivery)
+@receiver([post_save, post_delete], sender=models.Address)
+@receiver(m2m_changed, sender=models.Address.delivery.through)
+def invalidate_delivery_calendar(sender, **kwargs):
+    delivery_calendar.invalidate()
+
+
+@receiver([post_save, post_delete], sender=models.Section)
+@receiver([post_save, post_delete], sender=models.Product)
+@receiver([post_save, post_delete], sender=models.Pasta)
+@receiver([post_save, post_delete], sender=models.Sauce)
+@receiver([post_save, post_delete], sender=models.Difference)
+def invalidate_home_page(sender, **kwargs):
+    page_cache.home_page.invalidate()
+
+
+@receiver([post_save, post_delete], sender=models.Product)
+@receiver([post_save, post_delete], sender=models.Pasta)
+@receiver([post_save, post_delete], sender=models.Sauce)
+def invalidate_items_widget(sender, **kwargs):
+    widgets.ItemsWidget.invalidate()
+
+
+@receiver([post_save, post_delete], sender=models.Difference)
+def invalidate_difference_widget(sender, **kwargs):
+    widgets.DifferenceWidget.invalidate()
+
+
+@receiver([post_save, post_delete], sender=models.Section)
+def invalidate_widgets(sender, **kwargs):
+    for widget in widgets.registry.classes():
+        widget.invalidate()
+
+
+@receiver([post_save, post_delete], sender=models.Item)
+def refresh_order_totals(sender, instance, **kwargs):
+    models.Order.refresh_totals_many(models.Order.objects.filter(id=instance.order_id))
+
+
+@receiver(pre_save, sender=models.Product)
+@receiver(pre_save, sender=models.Pasta)
+@receiver(pre_save, sender=models.Sauce)
+def invalidate_renamed_product_detail(sender, instance, **kwargs):
+    if instance.pk is not None:
+        for slug in models.Product.objects.filter(pk=instance.pk).values_list('slug', flat=True):
+            product_cache.invalidate(slug)
+
+
+@receiver([post_save, post_delete], sender=models.Product)
+@receiver([post_save, post_delete], sender=models.Pasta)
+@receiver([post_save, post_delete], sender=models.Sauce)
+def invalidate_product_detail(sender, instance, **kwargs):
+    product_cache.invalidate(instance.slug)
@@ -4,6 +4,7 @@ var readyToScroll = true;
 var hashChanged = false;
 var documentScrollTop = 0;
 var ogOverride;
+var catalogue;
 
 
 function nextCheck(){
@@ -54,13 +55,30 @@ function hashCheck(){
     }
 }
 
+function showItemDetail(detail){
+    ogOverride = detail;
+    $("#modal").html( ogOverride['body'] ).addClass('shown');
+}
+
 function getItem(item){
+    if( catalogue && catalogue['products'][item] ){
+        showItemDetail(catalogue['products'][item]);
+        return;
+    }
     $.ajax({
         url: 'ajax/' + item + '/',
+        dataType: 'json',
+        cache: true
+    }).done(showItemDetail);
+}
+
+function loadCatalogue(){
+    $.ajax({
+        url: 'katalog/',
+        dataType: 'json',
         cache: true
     }).done(function( response ) {
-        ogOverride = JSON.parse(response);
-        $("#modal").html( ogOverride['body'] ).addClass('shown');
+        catalogue = response;
     });
 }
 
@@ -136,6 +154,7 @@ $(function(){
     $items = $('.item');
     head = 107;
     hashCheck();
+    loadCatalogue();
     $(window).on('hashchange', function(event) {
         hashCheck();
     });
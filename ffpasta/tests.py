@@ -0,0 +1,575 @@
+import json, os, requests, sqlite3, subprocess, sys, threading
+from unittest import mock
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.contrib.admin.sites import site
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import delivery_calendar, idoklad, models, pricing, product_cache, widgets
+from .fake_idoklad import FakeIdoklad
+
+
+class PublishActionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.section = models.Section.objects.create(headline='Produkty', link='produkty', widget='i')
+        self.pasta = models.Pasta.objects.create(name='fusilli', img='', unit_price=100, length=models.Pasta.SHORT,
+                                                 published=False)
+
+    def test_publish_and_hide_invalidate_items_widget(self):
+        admin = site._registry[models.Pasta]
+        self.assertNotIn('Fusilli', widgets.ItemsWidget().render(self.section))
+        admin.publish(None, models.Pasta.objects.filter(id=self.pasta.id))
+        self.assertIn('Fusilli', widgets.ItemsWidget().render(self.section))
+        admin.hide(None, models.Pasta.objects.filter(id=self.pasta.id))
+        self.assertNotIn('Fusilli', widgets.ItemsWidget().render(self.section))
+
+
+class SectionChangeTest(TestCase):
+    def test_section_change_invalidates_registered_widgets(self):
+        cache.clear()
+        versions = {widget.short_name: widget.get_version() for widget in widgets.registry.classes()}
+        models.Section.objects.create(headline='Kontakt', link='kontakt', widget='c')
+        for widget in widgets.registry.classes():
+            self.assertNotEqual(widget.get_version(), versions[widget.short_name])
+
+
+class StockConcurrencyTest(TransactionTestCase):
+    THREADS = 8
+    BOOKINGS = 25
+
+    def setUp(self):
+        self.user = User.objects.create(username='sklad')
+        self.product = models.Product.objects.create(name='fusilli', img='', unit_price=100)
+
+    def book(self, errors):
+        try:
+            for i in range(self.BOOKINGS):
+                models.StockTransaction(quantity=2, product_id=self.product.id, committed_by=self.user,
+                                        transaction_type=models.StockTransaction.PRODUCTION).save()
+                models.StockTransaction.bulk_book([models.StockTransaction(
+                    quantity=1, product_id=self.product.id, committed_by=self.user,
+                    transaction_type=models.StockTransaction.COMPLETION)])
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_concurrent_bookings_keep_stock_balance(self):
+        errors = []
+        threads = [threading.Thread(target=self.book, args=(errors,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.in_stock, self.THREADS * self.BOOKINGS)
+        self.assertEqual(models.StockTransaction.objects.filter(product=self.product).count(),
+                         2 * self.THREADS * self.BOOKINGS)
+
+    def test_bulk_book_clamps_after_each_movement_in_both_directions(self):
+        models.StockTransaction.bulk_book([
+            models.StockTransaction(quantity=quantity, product_id=self.product.id, committed_by=self.user,
+                                    transaction_type=transaction_type)
+            for quantity, transaction_type in ((5, models.StockTransaction.COMPLETION),
+                                               (3, models.StockTransaction.PRODUCTION))])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.in_stock, 3)
+
+
+class StockBookingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='sklad')
+        customer = models.Customer.objects.create(name='Zákazník', user=User.objects.create(username='zakaznik'))
+        self.fusilli = models.Pasta.objects.create(name='fusilli', img='', unit_price=100, length=models.Pasta.SHORT)
+        self.pesto = models.Sauce.objects.create(name='pesto', img='', unit_price=50, sauce_type=models.Sauce.PESTO)
+        self.book(models.StockTransaction.PRODUCTION, (self.fusilli, 5), (self.pesto, 10))
+        self.orders = []
+        for quantity in (3, 3, 2):
+            order = models.Order.objects.create(customer=customer, date_required=date(2025, 1, 1))
+            models.Item.objects.create(order=order, product=self.fusilli, quantity=quantity)
+            models.Item.objects.create(order=order, product=self.pesto, quantity=1)
+            self.orders.append(order)
+
+    def book(self, transaction_type, *movements):
+        return models.StockTransaction.bulk_book([
+            models.StockTransaction(quantity=quantity, product_id=product.id, committed_by=self.user,
+                                    transaction_type=transaction_type)
+            for product, quantity in movements])
+
+    def get_stock(self):
+        return dict(models.Product.objects.values_list('name', 'in_stock'))
+
+    def test_bulk_book_clamps_summed_movements_at_zero(self):
+        self.book(models.StockTransaction.COMPLETION, (self.fusilli, 4), (self.fusilli, 4), (self.pesto, 3))
+        self.assertEqual(self.get_stock(), {'fusilli': 0, 'pesto': 7})
+        self.assertEqual(models.StockTransaction.objects.filter(
+            transaction_type=models.StockTransaction.COMPLETION).count(), 3)
+
+    def test_complete_many_books_total_demand_in_stock(self):
+        orders = models.Order.objects.filter(id__in=[order.id for order in self.orders[1:]]).order_by('id')
+        results = models.Order.complete_many(orders, self.user)
+        self.assertEqual([err_msg for order, err_msg in results], [None, None])
+        self.assertEqual(self.get_stock(), {'fusilli': 0, 'pesto': 8})
+        self.assertEqual(models.Order.objects.filter(status=models.Order.COMPLETED).count(), 2)
+
+    def test_complete_many_checks_orders_one_by_one_when_stock_does_not_suffice(self):
+        models.Order.objects.filter(id=self.orders[0].id).update(status=models.Order.REJECTED)
+        extra = models.Order.objects.create(customer=self.orders[0].customer, date_required=date(2025, 1, 1))
+        models.Item.objects.create(order=extra, product=self.fusilli, quantity=3)
+        results = models.Order.complete_many(models.Order.objects.order_by('id'), self.user)
+        self.assertEqual([order.id for order, err_msg in results], [order.id for order in self.orders] + [extra.id])
+        self.assertEqual([err_msg is None for order, err_msg in results], [False, True, True, False])
+        self.assertIn('ve stavu zamítnuto', results[0][1])
+        self.assertIn('není dostatek produktu Fusilli', results[3][1])
+        self.assertEqual(self.get_stock(), {'fusilli': 0, 'pesto': 8})
+        self.assertEqual(list(models.Order.objects.filter(status=models.Order.COMPLETED).values_list('id', flat=True)
+                              .order_by('id')), [self.orders[1].id, self.orders[2].id])
+
+class OrderListViewTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='zakaznik', password='heslo')
+        customer = models.Customer.objects.create(name='Zákazník', user=user, email_is_verified=True)
+        for i in range(30):
+            models.Order.objects.create(customer=customer, date_required=date(2025, 1, 1) + timedelta(days=i // 2),
+                                        datetime_ordered=datetime.now(), summary=f'objednávka { i }', total_price=i)
+        self.client.force_login(user)
+
+    def test_pages_load_in_constant_number_of_queries(self):
+        with self.assertNumQueries(4):
+            response = self.client.get('/objednavky/')
+        self.assertEqual(len(response.context['object_list']), 25)
+        with self.assertNumQueries(4):
+            response = self.client.get('/objednavky/', {'starsi': response.context['next_cursor']})
+        self.assertEqual(len(response.context['object_list']), 5)
+        self.assertNotIn('next_cursor', response.context)
+
+
+class ProductCatalogueViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        models.Pasta.objects.create(name='fusilli', img='', unit_price=100, length=models.Pasta.SHORT)
+
+    def test_encodings_have_distinct_etags(self):
+        gzipped = self.client.get('/katalog/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        plain = self.client.get('/katalog/', HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertEqual(gzipped['Content-Encoding'], 'gzip')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertNotEqual(gzipped['ETag'], plain['ETag'])
+        response = self.client.get('/katalog/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzipped['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/katalog/', HTTP_IF_NONE_MATCH=gzipped['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], plain['ETag'])
+
+
+class ProductDetailViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        models.Pasta.objects.create(name='fusilli', img='', unit_price=100, length=models.Pasta.SHORT)
+
+    def test_unknown_product_creates_no_version(self):
+        self.assertEqual(self.client.get('/ajax/neznamy/').status_code, 404)
+        self.assertIsNone(product_cache.get_version('neznamy'))
+        response = self.client.get('/ajax/fusilli/')
+        self.assertEqual(response['ETag'], product_cache.get_etag('fusilli', product_cache.get_version('fusilli')))
+
+
+
+class HomeViewTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        models.Section.objects.create(headline='Produkty', link='produkty', widget='i')
+
+    def test_page_without_form_sets_no_csrf_cookie(self):
+        for i in range(2):
+            response = self.client.get('/')
+            self.assertNotIn(settings.CSRF_COOKIE_NAME, response.cookies)
+
+    def test_page_with_form_gets_visitor_token(self):
+        models.Section.objects.create(headline='Kontakt', link='kontakt', widget='c')
+        for i in range(2):
+            response = self.client.get('/')
+            self.assertIn(settings.CSRF_COOKIE_NAME, response.cookies)
+            self.assertNotContains(response, 'CSRF_TOKEN_PLACEHOLDER')
+
+
+def limit_query_params(limit=999):
+    """
+    Limit the number of query parameters of the test database connection like older SQLite builds do.
+    """
+    connection.ensure_connection()
+    if connection.vendor == 'sqlite':
+        connection.connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+
+
+class DeliveryNotesTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='zakaznik', password='heslo')
+        self.customer = models.Customer.objects.create(name='Zákazník', user=user, ico=12345678, street='Ulice 1',
+                                                       postal_code=10000, city='Praha')
+        models.Order.objects.bulk_create([models.Order(customer=self.customer, date_required=date(2025, 1, 1))
+                                          for i in range(200)])
+        limit_query_params()
+
+    def test_numbers_many_orders_within_query_parameter_limit(self):
+        results = models.Order.create_delivery_notes(models.Order.objects.order_by('id'))
+        self.assertEqual([number for order, number in results], list(range(1, 201)))
+        self.assertEqual(models.Order.objects.filter(delivery_note_number__isnull=True).count(), 0)
+
+
+class OrderTotalsTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='zakaznik', password='heslo')
+        customer = models.Customer.objects.create(name='Zákazník', user=user)
+        self.product = models.Pasta.objects.create(name='fusilli', img='', unit_price=100, length=models.Pasta.SHORT)
+        self.order = models.Order.objects.create(customer=customer, date_required=date(2025, 1, 1))
+
+    def test_item_save_and_delete_refresh_order_totals(self):
+        item = models.Item.objects.create(order=self.order, product=self.product, quantity=2)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.total_price, self.order.item_count), (200, 1))
+        self.assertEqual(self.order.summary, 'fusilli 2kg')
+        item.quantity = 3
+        item.save()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.total_price, 300)
+        item.delete()
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.total_price, self.order.item_count, self.order.summary), (0, 0, ''))
+
+    def test_refresh_many_orders_within_query_parameter_limit(self):
+        models.Order.objects.bulk_create([models.Order(customer=self.order.customer, date_required=date(2025, 1, 1))
+                                          for i in range(500)])
+        orders = models.Order.objects.order_by('id')
+        models.Item.objects.bulk_create([models.Item(order=order, product=self.product, quantity=1, unit_price=100,
+                                                     name='fusilli') for order in orders])
+        limit_query_params()
+        batch = models.Order.objects.filter(id__in=list(orders.values_list('id', flat=True)[:500]))
+        self.assertEqual(len(models.Order.refresh_totals_many(batch)), 500)
+        self.assertEqual(models.Order.objects.filter(item_count=1).count(), 500)
+
+
+class PriceResolverTest(TestCase):
+    def setUp(self):
+        self.customer = models.Customer.objects.create(name='Zákazník', user=User.objects.create(username='zakaznik'))
+        category = models.PriceCategory.objects.create(name='omáčky', unit_price=60)
+        self.fusilli = models.Pasta.objects.create(name='fusilli', img='', unit_price=100, length=models.Pasta.SHORT)
+        self.penne = models.Pasta.objects.create(name='penne', img='', unit_price=90, length=models.Pasta.SHORT)
+        self.pesto = models.Sauce.objects.create(name='pesto', img='', price_category=category,
+                                                 sauce_type=models.Sauce.PESTO)
+        self.ragu = models.Sauce.objects.create(name='ragu', img='', price_category=category,
+                                                sauce_type=models.Sauce.PESTO)
+        models.Price.objects.create(customer=self.customer, product=self.fusilli, unit_price=80)
+        models.Price.objects.create(customer=self.customer, price_category=category, unit_price=55)
+        models.Price.objects.create(customer=self.customer, product=self.ragu, unit_price=45)
+
+    def test_resolves_product_category_and_list_price(self):
+        with self.assertNumQueries(2):
+            resolver = pricing.PriceResolver(self.customer.id)
+        with self.assertNumQueries(0):
+            prices = {product.name: resolver.get_unit_price(product.id)
+                      for product in (self.fusilli, self.penne, self.pesto, self.ragu)}
+        self.assertEqual(prices, {'fusilli': 80, 'penne': 90, 'pesto': 55, 'ragu': 45})
+
+    def test_resolve_keeps_given_unit_price(self):
+        items = [models.Item(product_id=self.fusilli.id, quantity=1),
+                 models.Item(product_id=self.penne.id, quantity=1, unit_price=70)]
+        resolver = pricing.PriceResolver(self.customer.id, product_ids=[self.fusilli.id, self.penne.id])
+        with self.assertNumQueries(0):
+            resolver.resolve(items)
+        self.assertEqual([(item.name, item.unit_price) for item in items], [('fusilli', 80), ('penne', 70)])
+
+
+class DeliveryCalendarTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = models.Customer.objects.create(name='Zákazník', user=User.objects.create(username='zakaznik'))
+        self.monday = models.Delivery.objects.create(name='pondělí', monday=True)
+        models.Delivery.objects.create(name='středa', wednesday=True)
+        self.assigned = models.Address.objects.create(street='Ulice 1', postal_code=10000, city='Praha',
+                                                      customer=self.customer)
+        self.assigned.delivery.add(self.monday)
+        self.unassigned = models.Address.objects.create(street='Ulice 2', postal_code=10000, city='Praha',
+                                                        customer=self.customer)
+
+    def get_weekdays(self, dates):
+        return {datetime.strptime(day, '%Y-%m-%d').weekday() for day in dates}
+
+    def test_dates_follow_address_deliveries(self):
+        dates = delivery_calendar.get_dates(self.customer.id)
+        self.assertEqual(self.get_weekdays(dates[self.assigned.id]), {0})
+        self.assertEqual(self.get_weekdays(dates[self.unassigned.id]), {0, 2})
+        self.assertGreater(min(dates[self.assigned.id]), str(date.today()))
+        self.assertLessEqual(max(dates[self.assigned.id]),
+                             str(date.today() + timedelta(days=delivery_calendar.DAYS_AHEAD + 1)))
+
+    def test_orders_after_noon_start_day_after_tomorrow(self):
+        with mock.patch.object(delivery_calendar.timezone, 'now', return_value=datetime(2025, 1, 1, 11, 59)):
+            self.assertEqual(delivery_calendar.get_start_day(), date.today() + timedelta(days=1))
+        with mock.patch.object(delivery_calendar.timezone, 'now', return_value=datetime(2025, 1, 1, 12)):
+            self.assertEqual(delivery_calendar.get_start_day(), date.today() + timedelta(days=2))
+
+    def test_delivery_changes_invalidate_cached_dates(self):
+        delivery_calendar.get_dates(self.customer.id)
+        with self.assertNumQueries(0):
+            delivery_calendar.get_dates(self.customer.id)
+        self.monday.friday = True
+        self.monday.save()
+        self.assertEqual(self.get_weekdays(delivery_calendar.get_dates(self.customer.id)[self.assigned.id]), {0, 4})
+        self.assigned.delivery.clear()
+        self.assertEqual(self.get_weekdays(delivery_calendar.get_dates(self.customer.id)[self.assigned.id]), {0, 2, 4})
+
+TOKEN_SCRIPT = """
+import sys, django
+from django.conf import settings
+settings.DATABASES['default']['NAME'] = sys.argv[1]
+settings.IDOKLAD_API_URL, settings.IDOKLAD_AUTH_URL = sys.argv[2:4]
+django.setup()
+from ffpasta import idoklad
+print(idoklad.TokenManager().get())
+"""
+
+
+class TokenManagerProcessesTest(TransactionTestCase):
+    def setUp(self):
+        idoklad.token_manager.cache.delete(idoklad.TokenManager.KEY)
+
+    def test_processes_share_one_token(self):
+        fake = FakeIdoklad(latency=0.5)
+        with fake:
+            processes = [subprocess.Popen([sys.executable, '-c', TOKEN_SCRIPT, connection.settings_dict['NAME'],
+                                           fake.api_url, fake.auth_url],
+                                          cwd=settings.BASE_DIR, env=os.environ, stdout=subprocess.PIPE)
+                         for i in range(4)]
+            tokens = {process.communicate(timeout=60)[0].decode().strip() for process in processes}
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(fake.requests[('POST', fake.AUTH_PATH)], 1)
+        self.assertEqual(idoklad.TokenManager().get(), tokens.pop())
+
+
+class SyncCustomersToIdokladTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        idoklad.token_manager.cache.delete(idoklad.TokenManager.KEY)
+        self.fake = FakeIdoklad().start()
+        self.addCleanup(self.fake.stop)
+        User.objects.bulk_create([User(username=f'zakaznik-{ i }') for i in range(400)])
+        models.Customer.objects.bulk_create([
+            models.Customer(name=f'Zákazník { i }', user=user, ico=10000000 + i, street='Ulice 1', postal_code=10000,
+                            city='Praha') for i, user in enumerate(User.objects.order_by('id'))])
+        for i in range(0, 400, 2):
+            self.fake.add_contact(CompanyName='starý název', IdentificationNumber=str(10000000 + i))
+
+    def test_reports_failed_customers(self):
+        handle = self.fake.handle
+
+        def failing_handle(method, path, query, body):
+            if method == 'PUT' and path == '/api/v2/Contacts/1' or \
+                    method == 'POST' and json.loads(body)['CompanyName'] == 'Zákazník 1':
+                return 500, {'Message': 'Chyba'}
+            return handle(method, path, query, body)
+        self.fake.handle = failing_handle
+        limit_query_params()
+        with override_settings(IDOKLAD_API_URL=self.fake.api_url, IDOKLAD_AUTH_URL=self.fake.auth_url,
+                               IDOKLAD_MAX_RETRIES=0):
+            failed = idoklad.sync_customers_to_idoklad(models.Customer.objects.all())
+        self.assertEqual(sorted(customer.name for customer, err_msg in failed), ['Zákazník 0', 'Zákazník 1'])
+        self.assertTrue(all(err_msg.startswith('HTTP 500') for customer, err_msg in failed))
+        self.assertEqual(models.Customer.objects.filter(id_idoklad__isnull=True).get().name, 'Zákazník 1')
+
+
+@override_settings(IDOKLAD_TOKEN_CACHE='default', IDOKLAD_MAX_RETRIES=0)
+class InvoiceJobTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.fake = FakeIdoklad().start()
+        self.addCleanup(self.fake.stop)
+        settings_override = override_settings(IDOKLAD_API_URL=self.fake.api_url, IDOKLAD_AUTH_URL=self.fake.auth_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        user = User.objects.create_user(username='zakaznik', password='heslo')
+        self.customer = models.Customer.objects.create(name='Zákazník', user=user)
+        models.Customer.objects.filter(id=self.customer.id).update(id_idoklad=self.fake.add_contact()['Id'])
+
+    def create_jobs(self, count):
+        orders = []
+        for i in range(count):
+            order = models.Order.objects.create(customer=self.customer, date_required=date(2025, 1, 1))
+            pasta = models.Pasta.objects.create(name=f'fusilli { order.id }', img='', unit_price=100,
+                                                length=models.Pasta.SHORT)
+            sauce = models.Sauce.objects.create(name=f'pesto { order.id }', img='', unit_price=50,
+                                                sauce_type=models.Sauce.PESTO)
+            models.Item.objects.create(order=order, product=pasta, quantity=1, unit_price=100)
+            models.Item.objects.create(order=order, product=sauce, quantity=2, unit_price=50)
+            orders.append(order.id)
+        jobs, skipped = models.InvoiceJob.enqueue(models.Order.objects.filter(id__in=orders), models.InvoiceJob.BY_ORDER)
+        return models.InvoiceJob.claim(ids=[job.id for job in jobs])
+
+    def test_loads_data_of_any_number_of_jobs_in_constant_number_of_queries(self):
+        jobs = self.create_jobs(2)
+        with CaptureQueriesContext(connection) as few:
+            models.InvoiceJob.process_many(jobs)
+        jobs = self.create_jobs(6)
+        with CaptureQueriesContext(connection) as many:
+            models.InvoiceJob.process_many(jobs)
+        self.assertEqual(len(many), len(few))
+        self.assertEqual(models.Order.objects.filter(invoiced=True).count(), 8)
+        invoice = next(iter(self.fake.invoices.values()))
+        self.assertEqual([item['Unit'] for item in invoice['IssuedInvoiceItems']], ['kg', 'ks'])
+
+    def test_job_with_broken_data_fails_alone(self):
+        jobs = self.create_jobs(2)
+        broken = models.InvoiceJob.objects.create(kind=models.InvoiceJob.BY_DELIVERY_NOTES, customer=self.customer)
+        jobs += models.InvoiceJob.claim(ids=[broken.id])
+        report = dict(models.InvoiceJob.process_many(jobs))
+        self.assertEqual([job.id for job, err_msg in report.items() if err_msg], [broken.id])
+        broken.refresh_from_db()
+        self.assertEqual((broken.status, broken.attempts, broken.locked_until), (models.InvoiceJob.PENDING, 1, None))
+        self.assertTrue(broken.last_error.startswith('IndexError'))
+        self.assertGreater(broken.next_attempt, broken.created)
+        self.assertEqual(models.InvoiceJob.objects.filter(status=models.InvoiceJob.DONE).count(), 2)
+
+
+    def fail_invoices(self):
+        handle = self.fake.handle
+
+        def failing_handle(method, path, query, body):
+            if method == 'POST' and path == '/api/v2/IssuedInvoices':
+                return 500, {'Message': 'Internal server error'}
+            return handle(method, path, query, body)
+        self.fake.handle = failing_handle
+        return handle
+
+    def test_claimed_job_is_claimed_again_only_after_its_lock_expires(self):
+        job, = self.create_jobs(1)
+        self.assertEqual((job.status, job.attempts), (models.InvoiceJob.PROCESSING, 1))
+        self.assertEqual(models.InvoiceJob.claim(), [])
+        models.InvoiceJob.objects.filter(id=job.id).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual([(job.id, job.attempts) for job in models.InvoiceJob.claim()], [(job.id, 2)])
+
+    @override_settings(INVOICE_JOB_MAX_ATTEMPTS=3)
+    def test_failed_job_backs_off_until_max_attempts_then_retry_posts_it_once(self):
+        job, = self.create_jobs(1)
+        handle = self.fail_invoices()
+        for backoff in (60, 120):
+            self.assertFalse(job.process())
+            job.refresh_from_db()
+            self.assertEqual(job.status, models.InvoiceJob.PENDING)
+            self.assertAlmostEqual((job.next_attempt - timezone.now()).total_seconds(), backoff, delta=5)
+            self.assertEqual(models.InvoiceJob.claim(), [])
+            models.InvoiceJob.objects.filter(id=job.id).update(next_attempt=timezone.now())
+            job, = models.InvoiceJob.claim()
+        self.assertFalse(job.process())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (models.InvoiceJob.FAILED, 3))
+        self.assertTrue(job.last_error.startswith('HTTPError: 500'))
+        self.assertEqual(models.InvoiceJob.claim(), [])
+        self.fake.handle = handle
+        self.assertEqual(job.retry(), 1)
+        job, = models.InvoiceJob.claim()
+        self.assertTrue(job.process())
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.invoice_id_idoklad), (models.InvoiceJob.DONE, next(iter(self.fake.invoices))))
+        self.assertEqual(len(self.fake.invoices), 1)
+        self.assertTrue(job.orders.get().invoiced)
+
+@override_settings(IDOKLAD_TOKEN_CACHE='default', IDOKLAD_MAX_RETRIES=0, IDOKLAD_PAGE_SIZE=2)
+class ContactMirrorTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.fake = FakeIdoklad().start()
+        self.addCleanup(self.fake.stop)
+        settings_override = override_settings(IDOKLAD_API_URL=self.fake.api_url, IDOKLAD_AUTH_URL=self.fake.auth_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        for i in range(5):
+            self.fake.add_contact(CompanyName=f'Firma { i }', IdentificationNumber=str(10000000 + i))
+        idoklad.refresh_contact_mirror(full=True)
+
+    def fail_page(self, page):
+        handle = self.fake.handle
+
+        def failing_handle(method, path, query, body):
+            if path == '/api/v2/Contacts' and query.get('page') == str(page):
+                return 503, {'Message': 'Service unavailable'}
+            return handle(method, path, query, body)
+        self.fake.handle = failing_handle
+        return handle
+
+    def test_failed_delta_refresh_keeps_cursor(self):
+        cursor = idoklad.get_contacts_cursor()
+        for i in range(5, 10):
+            self.fake.add_contact(CompanyName=f'Firma { i }', IdentificationNumber=str(10000000 + i))
+        handle = self.fail_page(2)
+        with self.assertRaises(requests.HTTPError):
+            idoklad.refresh_contact_mirror()
+        self.assertEqual(idoklad.get_contacts_cursor(), cursor)
+        self.fake.handle = handle
+        idoklad.refresh_contact_mirror()
+        self.assertEqual(models.IdokladContact.objects.count(), 10)
+
+    def test_failed_full_refresh_deletes_nothing(self):
+        self.fake.contacts.pop(1)
+        self.fail_page(2)
+        with self.assertRaises(requests.HTTPError):
+            idoklad.refresh_contact_mirror(full=True)
+        self.assertEqual(models.IdokladContact.objects.count(), 5)
+
+    def test_full_refresh_of_many_contacts_within_query_parameter_limit(self):
+        for i in range(5, 1200):
+            self.fake.add_contact(CompanyName=f'Firma { i }', IdentificationNumber=str(10000000 + i))
+        self.fake.contacts.pop(1)
+        limit_query_params()
+        with override_settings(IDOKLAD_PAGE_SIZE=200):
+            idoklad.refresh_contact_mirror(full=True)
+        self.assertEqual(models.IdokladContact.objects.count(), 1199)
+        self.assertFalse(models.IdokladContact.objects.filter(id_idoklad=1).exists())
+
+    def test_sync_customers_from_large_mirror(self):
+        for i in range(5, 1200):
+            self.fake.add_contact(CompanyName=f'Firma { i }', IdentificationNumber=str(10000000 + i))
+        User.objects.bulk_create([User(username=f'zakaznik-{ i }') for i in range(3)])
+        models.Customer.objects.bulk_create([models.Customer(name='', user=user, ico=10000000 + i * 500)
+                                             for i, user in enumerate(User.objects.order_by('id'))])
+        limit_query_params()
+        with override_settings(IDOKLAD_PAGE_SIZE=200):
+            idoklad.sync_customers_from_idoklad(models.Customer.objects.all())
+        self.assertEqual(sorted(models.Customer.objects.values_list('name', flat=True)),
+                         ['Firma 0', 'Firma 1000', 'Firma 500'])
+
+
+class OrderTransitionTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='zakaznik', password='heslo')
+        customer = models.Customer.objects.create(name='Zákazník', user=user)
+        self.orders = [models.Order.objects.create(customer=customer, date_required=date(2025, 1, 1), status=status)
+                       for status in (models.Order.PENDING, models.Order.CONFIRMED, models.Order.PENDING)]
+
+    def test_reports_orders_moved_by_another_worker_as_skipped(self):
+        queryset = models.Order.objects.filter(id__in=[order.id for order in self.orders]).order_by('id')
+        update = models.OrderQuerySet.update
+
+        def concurrent_update(queryset, **kwargs):
+            models.Order._base_manager.filter(id=self.orders[2].id).update(status=models.Order.REJECTED)
+            return update(queryset, **kwargs)
+        with mock.patch.object(models.OrderQuerySet, 'update', concurrent_update):
+            moved, skipped = queryset.transition(models.Order.PENDING, models.Order.CONFIRMED)
+        self.assertEqual([order.id for order in moved], [self.orders[0].id])
+        self.assertEqual([(order.id, order.status) for order in skipped],
+                         [(self.orders[1].id, models.Order.CONFIRMED), (self.orders[2].id, models.Order.REJECTED)])
+
+    def test_admin_reports_in_queryset_order(self):
+        request = RequestFactory().post('/')
+        request._messages = CookieStorage(request)
+        site._registry[models.Order].confirm(request, models.Order.objects.order_by('id'))
+        self.assertEqual([message.level_tag for message in get_messages(request)], ['info', 'error', 'info'])
@@ -28,6 +28,7 @@ urlpatterns = [
     path('dokonceni-objednavky/', views.OrderFinishView.as_view()),
     path('admin/', admin.site.urls),
     path('produkce/', production_admin.urls),
+    path('katalog/', views.ProductCatalogueView.as_view()),
     path('ajax/<slug:slug>/', views.ProductDetailView.as_view()),
 ]
 if settings.DEBUG:
@@ -5,13 +5,20 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.auth.views import LoginView
 from django.core.cache import cache
-from django.http import HttpResponseRedirect, Http404
+from django.db import transaction
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseNotModified, HttpResponseRedirect, Http404
+from django.middleware.csrf import get_token
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.html import mark_safe
+from django.utils.http import parse_etags
 from django.utils.crypto import get_random_string
-from django.views.generic import FormView, ListView, DetailView, UpdateView
+from django.views.generic import FormView, ListView, DetailView, UpdateView, View
 from datetime import datetime
-from . import forms, models
+from functools import partial
+from . import delivery_calendar, forms, models, page_cache, product_cache
 
 
 class NoLabelSuffixMixin:
@@ -28,11 +35,35 @@ class Home(ListView):
     def get_context_data(self, *args, **kwargs):
         context_data = super().get_context_data(*args, **kwargs)
         for obj in self.object_list:
-            if obj.widget:
-                obj.widget_context = obj.get_widget().get_context_data(self)
+            widget = obj.get_widget()
+            if widget is not None:
+                obj.widget_html = partial(widget().render, obj, self.request)
         context_data['og_appId'] = settings.FB_APP_ID
         return context_data
 
+    def get(self, request, *args, **kwargs):
+        if request.user.is_authenticated or len(messages.get_messages(request)):
+            content = self.render_page(request)
+        else:
+            content = page_cache.home_page.get(self.render_page)
+        if page_cache.CSRF_PLACEHOLDER in content:
+            content = content.replace(page_cache.CSRF_PLACEHOLDER, get_token(request))
+        return HttpResponse(content)
+
+    def render_page(self, request=None):
+        """
+        Render the page with a placeholder in place of the csrf token.
+
+        The placeholder is replaced in get only when the page contains a form, so pages without one
+        do not set the csrf cookie.
+
+        Without request, the page is rendered for anonymous visitor, to be cached.
+        """
+        self.object_list = self.get_queryset()
+        context_data = self.get_context_data()
+        context_data['csrf_token'] = page_cache.CSRF_PLACEHOLDER
+        return render_to_string(self.template_name, context_data, request)
+
 
 class ContactView(FormView):
     template_name = 'ffpasta/contact.html'
@@ -86,13 +117,71 @@ class RegistrationView(NoLabelSuffixMixin, FormView):
         return super().post(request, *args, **kwargs)
 
 
-class ProductDetailView(DetailView):
-    model = models.Product
+class ProductDetailView(View):
+    """
+    Return JSON document with Open Graph data and rendered detail of product.
 
-    def get_context_data(self, **kwargs):
-        context_data = super().get_context_data(**kwargs)
-        context_data['domain'] = settings.DOMAIN
-        return context_data
+    The document is served from cache with a strong ETag, a request with matching If-None-Match
+    is answered with 304 without touching the database.
+    """
+    def get(self, request, slug):
+        version = product_cache.get_version(slug)
+        if version is not None and product_cache.get_etag(slug, version) in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            content, version = product_cache.get_detail(slug)
+            if content is None:
+                raise Http404('Produkt nenalezen')
+            response = HttpResponse(content, content_type='application/json; charset=utf-8')
+        response['ETag'] = product_cache.get_etag(slug, version)
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'PRODUCT_DETAIL_MAX_AGE', 300))
+        return response
+
+
+def accepts_gzip(request):
+    """
+    Return whether Accept-Encoding of request allows gzip, respecting q-values.
+    """
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, *params = [part.strip() for part in coding.split(';')]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name:
+            qualities[name.lower()] = quality
+    return qualities.get('gzip', qualities.get('*', 0)) > 0
+
+
+class ProductCatalogueView(View):
+    """
+    Return JSON document with Open Graph data and rendered details of all published products, keyed by slug.
+
+    The document carries its version and is served gzipped to clients accepting it, with a strong ETag
+    distinct for each encoding and 304 for a request with matching If-None-Match, without touching the database.
+    """
+    def get(self, request):
+        gzipped = accepts_gzip(request)
+        suffix = '-gz' if gzipped else ''
+        version = product_cache.get_catalogue_version()
+        if version is not None and f'"{ version }{ suffix }"' in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            content, compressed, version = product_cache.get_catalogue()
+            if gzipped:
+                response = HttpResponse(compressed, content_type='application/json; charset=utf-8')
+                response['Content-Encoding'] = 'gzip'
+            else:
+                response = HttpResponse(content, content_type='application/json; charset=utf-8')
+        response['ETag'] = f'"{ version }{ suffix }"'
+        patch_vary_headers(response, ['Accept-Encoding'])
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'PRODUCT_DETAIL_MAX_AGE', 300))
+        return response
 
 
 class RecipeDetailView(DetailView):
@@ -191,10 +280,31 @@ class CustomerUpdateView(LoginRequiredMixin, CustomerRequiredMixin, NoLabelSuffi
 
 class OrderListView(LoginRequiredMixin, CustomerRequiredMixin, ListView):
     model = models.Order
+    page_size = 25
+    cursor_kwarg = 'starsi'
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        return queryset.filter(customer=self.request.user.customer.pk, datetime_ordered__isnull=False).order_by('-date_required')
+        queryset = queryset.filter(customer=self.request.user.customer.pk, datetime_ordered__isnull=False)
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        if cursor:
+            try:
+                date_required, id = cursor.split('_')
+                date_required, id = datetime.strptime(date_required, '%Y-%m-%d').date(), int(id)
+            except ValueError:
+                raise Http404("Stránka nenalezena.")
+            queryset = queryset.filter(Q(date_required__lt=date_required) | Q(date_required=date_required, id__lt=id))
+        return queryset.order_by('-date_required', '-id')
+
+    def get_context_data(self, **kwargs):
+        orders = list(self.object_list[:self.page_size + 1])
+        context_data = super().get_context_data(object_list=orders[:self.page_size], **kwargs)
+        if len(orders) > self.page_size:
+            last = orders[self.page_size - 1]
+            context_data['next_cursor'] = f'{ last.date_required }_{ last.id }'
+        context_data['cursor_kwarg'] = self.cursor_kwarg
+        context_data['cursor'] = self.request.GET.get(self.cursor_kwarg)
+        return context_data
 
 
 class OrderCreateUpdateView(LoginRequiredMixin, CustomerRequiredMixin, DeliveryAddressRequiredMixin, UpdateView):
@@ -245,13 +355,13 @@ class OrderCreateUpdateView(LoginRequiredMixin, CustomerRequiredMixin, DeliveryA
         return super().get_context_data(formset=self.formset)
 
     def dates(self):
-        return {address.id: address.get_dates() for address in self.request.user.customer.delivery_addresses.all()}
+        return delivery_calendar.get_dates(self.request.user.customer.id)
 
     def form_valid(self, form):
         if self.formset.is_valid():
-            response = super().form_valid(form)
-            models.Item.objects.filter(order=self.object).delete()
-            self.formset.save(self.object)
+            with transaction.atomic():
+                response = super().form_valid(form)
+                self.formset.save(self.object)
             return response
         return self.render_to_response(self.get_context_data(form=form, formset=self.formset))
 
@@ -344,12 +454,12 @@ def reject_order(request, id, token):
     if id and token:
         title = 'Objednávka NEodmítnuta'
         if token == cache.get(f'MANAGE_TOKEN_FOR_ORDER_{ id }'):
-            order = models.Order.objects.filter(id=id).first()
-            err_msg = order.do_reject()
-            if err_msg:
-                messages.add_message(request, messages.ERROR, err_msg)
-            else:
-                messages.add_message(request, messages.SUCCESS, f'Objednávka č. { order.id } byla úspěšně odmítnuta.')
+            moved, skipped = models.Order.objects.filter(id=id).transition(models.Order.PENDING, models.Order.REJECTED)
+            if skipped:
+                messages.add_message(request, messages.ERROR, models.Order.MANAGE_ERR_MSG.format(
+                    id, 'odmítnuta', skipped[0].get_status_display()))
+            elif moved:
+                messages.add_message(request, messages.SUCCESS, f'Objednávka č. { id } byla úspěšně odmítnuta.')
                 title = 'Objednávka odmítnuta'
         else:
             messages.add_message(request, messages.ERROR, mark_safe('Je mi líto, ale Tvému tokenu vypršela platnost.<br>Objednávku můžeš odmítnout běžným způsobem <a href=/objednavky/>v administraci</a>.'))
@@ -362,12 +472,12 @@ def confirm_order(request, id, token):
     if id and token:
         title = 'Objednávka NEpotvrzena'
         if token == cache.get(f'MANAGE_TOKEN_FOR_ORDER_{ id }'):
-            order = models.Order.objects.filter(id=id).first()
-            err_msg = order.do_confirm()
-            if err_msg:
-                messages.add_message(request, messages.ERROR, err_msg)
-            else:
-                messages.add_message(request, messages.SUCCESS, f'Objednávka č. { order.id } byla úspěšně potvrzena.')
+            moved, skipped = models.Order.objects.filter(id=id).transition(models.Order.PENDING, models.Order.CONFIRMED)
+            if skipped:
+                messages.add_message(request, messages.ERROR, models.Order.MANAGE_ERR_MSG.format(
+                    id, 'potvrzena', skipped[0].get_status_display()))
+            elif moved:
+                messages.add_message(request, messages.SUCCESS, f'Objednávka č. { id } byla úspěšně potvrzena.')
                 title = 'Objednávka potvrzena'
         else:
             messages.add_message(request, messages.ERROR, mark_safe('Je mi líto, ale Tvému tokenu vypršela platnost.<br>Objednávku můžeš potvrdit běžným způsobem <a href=/objednavky/>v administraci</a>.'))
@@ -1,6 +1,54 @@
 from django import forms
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
+from django.utils.safestring import mark_safe
 
-from . import models
+from . import models, page_cache
+
+
+class Registry:
+    """
+    Registry of widgets keyed by short_name.
+
+    Widget classes are collected by register decorator and indexed once by populate at app ready.
+    Iterating the registry yields model field choices, so it can be passed directly as `choices` of a field.
+    """
+    def __init__(self):
+        self._classes = []
+        self._widgets = {}
+        self._choices = ()
+
+    def register(self, widget_class):
+        self._classes.append(widget_class)
+        return widget_class
+
+    def populate(self):
+        widgets = {}
+        for widget_class in self._classes:
+            if widget_class.short_name in widgets:
+                raise ImproperlyConfigured(f'Widget short name "{ widget_class.short_name }" is not unique.')
+            widgets[widget_class.short_name] = widget_class
+        self._widgets = widgets
+        self._choices = tuple((short_name, widget_class.get_name()) for short_name, widget_class in widgets.items())
+
+    def __iter__(self):
+        return iter(self._choices)
+
+    def get(self, short_name):
+        return self._widgets.get(short_name)
+
+    def classes(self):
+        return list(self._widgets.values())
+
+    def __contains__(self, short_name):
+        return short_name in self._widgets
+
+
+registry = Registry()
 
 
 class Widget:
@@ -21,14 +69,11 @@ class Widget:
 
     @classmethod
     def get_choices(cls):
-        choices = [(sub_cls.short_name, sub_cls.get_name()) for sub_cls in cls.__subclasses__()]
-        return tuple(choices)
+        return tuple(registry)
 
     @classmethod
     def get_class(cls, short_name):
-        for sub_cls in cls.__subclasses__():
-            if sub_cls.short_name == short_name:
-                return sub_cls
+        return registry.get(short_name)
 
     @classmethod
     def get_name(cls):
@@ -36,7 +81,43 @@ class Widget:
             return cls.name
         return cls.__class__.__name__
 
+    @classmethod
+    def get_version(cls):
+        return cache.get_or_set(f'WIDGET_{ cls.short_name }_VERSION', 1, None)
+
+    @classmethod
+    def invalidate(cls):
+        try:
+            cache.incr(f'WIDGET_{ cls.short_name }_VERSION')
+        except ValueError:
+            cache.set(f'WIDGET_{ cls.short_name }_VERSION', 1, None)
+
+    def is_cacheable(self, request):
+        return True
 
+    def render(self, section, request=None):
+        """
+        Return rendered widget of given section.
+
+        The widget context is built lazily, only when the template uses it.
+
+        The rendering is cached until the widget version is invalidated, with a placeholder
+        in place of the csrf token. The request is used only when the widget is not cacheable for it.
+        """
+        if request is not None and not self.is_cacheable(request):
+            return mark_safe(render_to_string(self.template_name, {
+                'section': section, 'widget_context': SimpleLazyObject(self.get_context_data)}, request))
+        key = f'WIDGET_{ self.short_name }_{ section.id }_{ self.get_version() }'
+        content = cache.get(key)
+        if content is None:
+            content = render_to_string(self.template_name, {
+                'section': section, 'widget_context': SimpleLazyObject(self.get_context_data),
+                'csrf_token': page_cache.CSRF_PLACEHOLDER})
+            cache.set(key, content, getattr(settings, 'WIDGET_CACHE_TIMEOUT', 86400))
+        return mark_safe(content)
+
+
+@registry.register
 class ItemsWidget(Widget):
     name = 'Produkty'
     short_name = 'i'
@@ -44,13 +125,23 @@ class ItemsWidget(Widget):
 
     def get_context_data(self):
         context_data = {
-            'short_pasta_list': models.Pasta.objects.filter(length=models.Pasta.SHORT, published=True),
-            'long_pasta_list': models.Pasta.objects.filter(length=models.Pasta.LONG, published=True),
-            'sauce_list': models.Sauce.objects.filter(published=True)
+            'short_pasta_list': [],
+            'long_pasta_list': [],
+            'sauce_list': []
         }
+        products = models.Product.objects.filter(published=True).select_related('pasta', 'sauce')\
+            .only('name', 'slug', 'img', 'pasta__length', 'sauce__sauce_type')\
+            .order_by('pasta__length', '-sauce__sauce_type', 'name')
+        for product in products:
+            if hasattr(product, 'pasta'):
+                key = 'short_pasta_list' if product.pasta.length == models.Pasta.SHORT else 'long_pasta_list'
+                context_data[key].append(product)
+            elif hasattr(product, 'sauce'):
+                context_data['sauce_list'].append(product)
         return context_data
 
 
+@registry.register
 class DifferenceWidget(Widget):
     name = 'Rozdíly'
     short_name = 'r'
@@ -81,11 +172,15 @@ class ContactForm(forms.Form):
         return True
 
 
+@registry.register
 class ContactWidget(Widget):
     name = 'Kontakt'
     short_name = 'c'
     template_name = 'ffpasta/widgets/contact.html'
 
+    def is_cacheable(self, request):
+        return not len(messages.get_messages(request))
+
     def get_context_data(self):
         context_data = {
             'form' : ContactForm()
@@ -61,9 +61,23 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'data/db.sqlite3'),
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'data/test_db.sqlite3')},
     }
 }
 
+# The home page, widget and product caches are invalidated by bumping versions in the default cache,
+# so with more than one worker process it has to be shared by them, e.g. memcached.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'ffpasta_shared_cache',
+    },
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -125,5 +139,19 @@ IDOKLAD_API_URL = 'https://app.idoklad.cz/developer'
 IDOKLAD_AUTH_URL = 'https://app.idoklad.cz/identity/server/connect/token'
 IDOKLAD_CLIENT_ID = os.environ.get('IDOKLAD_CLIENT_ID', 'not client id')
 IDOKLAD_CLIENT_SECRET = os.environ.get('IDOKLAD_CLIENT_SECRET', 'not client secret')
+IDOKLAD_TIMEOUT = (3.05, 30)
+IDOKLAD_MAX_RETRIES = 3
+IDOKLAD_CONCURRENCY = 8
+IDOKLAD_PAGE_SIZE = 200
+IDOKLAD_TOKEN_REFRESH_MARGIN = 60
+IDOKLAD_TOKEN_LOCK_TIMEOUT = 10
+IDOKLAD_TOKEN_CACHE = 'shared'
+IDOKLAD_TEMPLATE_TIMEOUT = 3600
+INVOICE_JOB_MAX_ATTEMPTS = 5
+INVOICE_JOB_LOCK_TIMEOUT = 300
+
+PAGE_CACHE_TIMEOUT = 600
+WIDGET_CACHE_TIMEOUT = 86400
+PRODUCT_DETAIL_MAX_AGE = 300
 
 FB_APP_ID = os.environ.get('FB_APP_ID', None)